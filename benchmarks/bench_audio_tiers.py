@@ -0,0 +1,102 @@
+"""
+CPU seconds per audio minute of each audio tier, downloaded by the subprocess yt-dlp engine (so that yt-dlp
+and its ffmpeg count as children of this process) from a local HTTP server, with the arguments of
+get_postprocessing_args:
+- mp3: the opus stream re-encoded with MP3_AUDIO_QUALITY (one row per --mp3-quality)
+- m4a: the AAC stream remuxed
+- opus: the opus stream remuxed
+- download: the opus stream saved as is, the yt-dlp overhead subtracted from the "conversion" column
+
+The sources are generated with ffmpeg, like the native YouTube audio streams (AAC in m4a, opus in webm).
+
+    python benchmarks/bench_audio_tiers.py --minutes 10 --mp3-quality 0 5 9 192K --yt-dlp /opt/bin/yt-dlp
+"""
+import os
+import shutil
+import argparse
+import tempfile
+import functools
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from common import cpu_seconds, find_ffmpeg, load_lambda_function, make_audio, median, print_table
+
+SOURCES = {"m4a": ("source.m4a", "aac"), "webm": ("source.webm", "libopus")}
+TIER_SOURCES = {"mp3": "webm", "m4a": "m4a", "opus": "webm"}  # The stream each FORMATS entry picks on YouTube
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def download(lambda_function, tier, url, ffmpeg, download_dir):
+    """
+    Download and convert the url like download_video does for the tier, return the CPU time and the output size
+    """
+    shutil.rmtree(download_dir, ignore_errors=True)
+    os.makedirs(download_dir)
+    args = [
+        "--output", os.path.join(download_dir, "audio.%(ext)s"),
+        "--format", "b",
+        "--ffmpeg-location", ffmpeg,
+        *(lambda_function.get_postprocessing_args(tier) if tier in lambda_function.AUDIO_EXTENSIONS else []),
+        url]
+    extension = lambda_function.AUDIO_EXTENSIONS.get(tier, os.path.splitext(url)[1])
+    cpu_start = cpu_seconds()
+    file_path = lambda_function.run_yt_dlp_download(args, download_dir, extension)
+    cpu = cpu_seconds() - cpu_start
+    if not file_path or not os.path.exists(file_path):
+        raise Exception(f"{tier} download of {url} failed")
+    return cpu, os.path.getsize(file_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--minutes", type=float, default=10, help="length of the generated audio")
+    parser.add_argument("--mp3-quality", nargs="+", help="MP3_AUDIO_QUALITY values to compare (default: the bot's)")
+    parser.add_argument("--runs", type=int, default=3, help="downloads per tier")
+    parser.add_argument("--yt-dlp", default="/opt/bin/yt-dlp", help="yt-dlp zipapp")
+    parser.add_argument("--ffmpeg", help="ffmpeg used to generate and convert the audio")
+    args = parser.parse_args()
+
+    lambda_function = load_lambda_function()
+    lambda_function.YT_DLP_ENGINE = "subprocess"
+    lambda_function.YT_DLP_PATH = args.yt_dlp
+    lambda_function.YT_DLP_CACHE_STATS["restored"] = True  # No S3 snapshot to restore
+    ffmpeg = find_ffmpeg(args.ffmpeg)
+    minutes = args.minutes
+
+    tiers = [("download", None), ("m4a", None), ("opus", None)]
+    tiers.extend(("mp3", quality) for quality in args.mp3_quality or [lambda_function.MP3_AUDIO_QUALITY])
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        lambda_function.YT_DLP_CACHE_DIR = os.path.join(temp_dir, "yt_dlp_cache")
+        media_dir = os.path.join(temp_dir, "media")
+        os.makedirs(media_dir)
+        for file_name, codec in SOURCES.values():
+            make_audio(ffmpeg, os.path.join(media_dir, file_name), round(minutes * 60), codec)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=media_dir))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        urls = {source: f"http://127.0.0.1:{server.server_port}/{file_name}"
+                for source, (file_name, _) in SOURCES.items()}
+
+        rows, overhead = [], None
+        for tier, quality in tiers:
+            if quality is not None:
+                lambda_function.MP3_AUDIO_QUALITY = quality
+            results = [download(lambda_function, tier, urls[TIER_SOURCES.get(tier, "webm")], ffmpeg,
+                                os.path.join(temp_dir, "download")) for _ in range(args.runs)]
+            cpu = median([result[0] for result in results])
+            if tier == "download":
+                overhead = cpu
+            size = results[0][1]
+            rows.append([tier, quality, TIER_SOURCES.get(tier, "webm"), cpu, cpu / minutes,
+                         max(cpu - overhead, 0) / minutes, size / (1024 * 1024), size * 8 / (minutes * 60 * 1000)])
+        server.shutdown()
+
+    print_table(["tier", "mp3 quality", "source", "CPU s", "CPU s/min", "conversion CPU s/min", "MB", "kbps"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Download time of a fragmented (HLS) and a progressive (MP4, ranged requests) media for several yt-dlp download
+settings, served by a local HTTP server with a simulated latency and per connection bandwidth:
+- auto: the settings get_download_tuning picks for this machine (AWS_LAMBDA_FUNCTION_MEMORY_SIZE, CPUs, /tmp)
+- fragments=N: N concurrent fragments, through DOWNLOAD_TUNING_OVERRIDES like a deployment override
+- chunk=N MB: N MB ranged requests (--http-chunk-size) for the progressive download, with --chunk-mb
+
+The media are generated with ffmpeg. A per connection limit mimics the throttling of the video hosts, which
+is what the concurrent fragments work around.
+
+    python benchmarks/bench_download_tuning.py --fragments 1 4 8 16 --latency-ms 50 --connection-mbps 20
+    AWS_LAMBDA_FUNCTION_MEMORY_SIZE=3008 python benchmarks/bench_download_tuning.py --chunk-mb 1 10
+"""
+import os
+import re
+import time
+import shutil
+import argparse
+import tempfile
+import functools
+import subprocess
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from common import find_ffmpeg, load_lambda_function, make_video, median, print_table
+
+RESOLUTION = "veryhigh"  # The resolution the overrides are set for, any key of FORMATS
+SEND_CHUNK_SIZE = 64 * 1024
+HLS_SEGMENT_SECONDS = 2
+
+
+class ThrottledHandler(SimpleHTTPRequestHandler):
+    """
+    Static files with ranged requests, a latency before each answer and a bandwidth limit per connection
+    """
+    latency = 0
+    connection_mbps = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get('Range') or "")
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        sent, began = 0, time.time()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while sent < end - start + 1:
+                chunk = f.read(min(SEND_CHUNK_SIZE, end - start + 1 - sent))
+                if not chunk:
+                    break
+                try:
+                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                sent += len(chunk)
+                if self.connection_mbps:
+                    delay = sent * 8 / (self.connection_mbps * 1e6) - (time.time() - began)
+                    if delay > 0:
+                        time.sleep(delay)
+
+
+def make_hls(ffmpeg, video_path, hls_dir):
+    """
+    Cut the video into an HLS playlist of HLS_SEGMENT_SECONDS fragments
+    """
+    os.makedirs(hls_dir, exist_ok=True)
+    subprocess.run([
+        ffmpeg, "-y", "-loglevel", "error", "-i", video_path, "-c", "copy",
+        "-f", "hls", "-hls_time", str(HLS_SEGMENT_SECONDS), "-hls_playlist_type", "vod",
+        "-hls_segment_filename", os.path.join(hls_dir, "segment_%04d.ts"),
+        os.path.join(hls_dir, "index.m3u8")], check=True)
+
+
+def download(lambda_function, url, download_dir):
+    """
+    Download the url like download_video does (without the post-processing), return the size and the time taken
+    """
+    shutil.rmtree(download_dir, ignore_errors=True)
+    os.makedirs(download_dir)
+    args = [
+        "--output", os.path.join(download_dir, "video.%(ext)s"),
+        "--format", "b",  # The single file of the media, nothing to merge
+        "--fixup", "never",
+        *lambda_function.get_download_tuning_args(RESOLUTION),
+        url]
+    start = time.time()
+    file_path = lambda_function.run_yt_dlp_download(args, download_dir, ".mp4")
+    seconds = time.time() - start
+    if not file_path or not os.path.exists(file_path):
+        raise Exception(f"Download of {url} failed")
+    return os.path.getsize(file_path), seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=50, help="generated media size in MB")
+    parser.add_argument("--fragments", type=int, nargs="+", default=[1, 2, 4, 8, 16],
+                        help="concurrent fragments to compare with the automatic tuning")
+    parser.add_argument("--chunk-mb", type=int, nargs="+", help="HTTP chunk sizes in MB to compare as well")
+    parser.add_argument("--latency-ms", type=float, default=20, help="latency of each HTTP request")
+    parser.add_argument("--connection-mbps", type=float, default=40, help="bandwidth of each connection (0: none)")
+    parser.add_argument("--runs", type=int, default=3, help="downloads per setting")
+    parser.add_argument("--yt-dlp", default="/opt/bin/yt-dlp", help="yt-dlp zipapp")
+    parser.add_argument("--ffmpeg", help="ffmpeg used to generate the media")
+    args = parser.parse_args()
+
+    lambda_function = load_lambda_function()
+    lambda_function.YT_DLP_PATH = args.yt_dlp
+    lambda_function.YT_DLP_CACHE_STATS["restored"] = True  # No S3 snapshot to restore
+    ffmpeg = find_ffmpeg(args.ffmpeg)
+
+    settings = [("auto", {})]
+    settings.extend((f"fragments={count}", {"concurrent_fragments": count}) for count in args.fragments)
+    settings.extend((f"chunk={size}MB", {"http_chunk_size": size * 1024 * 1024}) for size in args.chunk_mb or [])
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        lambda_function.YT_DLP_CACHE_DIR = os.path.join(temp_dir, "yt_dlp_cache")
+        media_dir = os.path.join(temp_dir, "media")
+        video_path = make_video(ffmpeg, os.path.join(temp_dir, "video.mp4"), args.size * 8000 // 4128,
+                                video_kbps=4000)
+        make_hls(ffmpeg, video_path, os.path.join(media_dir, "hls"))
+        shutil.copy(video_path, os.path.join(media_dir, "video.mp4"))
+
+        ThrottledHandler.latency = args.latency_ms / 1000
+        ThrottledHandler.connection_mbps = args.connection_mbps or None
+        server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(ThrottledHandler, directory=media_dir))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        media = {"hls": f"{base_url}/hls/index.m3u8", "progressive": f"{base_url}/video.mp4"}
+
+        download(lambda_function, media["hls"], os.path.join(temp_dir, "download"))  # Loads yt-dlp
+        print(f"Automatic tuning: {lambda_function.get_download_tuning(RESOLUTION)}")
+        rows = []
+        for name, url in media.items():
+            for label, override in settings:
+                lambda_function.DOWNLOAD_TUNING_OVERRIDES[RESOLUTION] = override
+                tuning = lambda_function.get_download_tuning(RESOLUTION)
+                results = [download(lambda_function, url, os.path.join(temp_dir, "download"))
+                           for _ in range(args.runs)]
+                seconds = median([result[1] for result in results])
+                size_mb = results[0][0] / (1024 * 1024)
+                rows.append([name, label, tuning["concurrent_fragments"], tuning["http_chunk_size"] // (1024 * 1024),
+                             tuning["buffer_size"] // 1024, size_mb, seconds, size_mb * 8 / seconds])
+        server.shutdown()
+
+    print_table(["media", "setting", "fragments", "chunk MB", "buffer KB", "MB", "median s", "Mbps"], rows)
+
+
+if __name__ == "__main__":
+    main()
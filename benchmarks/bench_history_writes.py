@@ -0,0 +1,67 @@
+"""
+Throughput of the message history writes for bursts of messages, against a local DynamoDB stand-in
+(DynamoDB Local through DYNAMODB_ENDPOINT_URL, moto in-process otherwise):
+- put_item: one PutItem per message, as before the buffered writer
+- per_update: the worker path, each message buffered then flushed before its command runs
+- buffered: the messages of the burst buffered and written by BatchWriteItem (HISTORY_BUFFER_SIZE per batch)
+
+--rtt-ms adds a round trip to each DynamoDB request, since the in-process stand-in has no network.
+
+    python benchmarks/bench_history_writes.py --bursts 1 10 100 1000 --rtt-ms 5
+"""
+import time
+import argparse
+
+from common import create_stand_in_resources, load_lambda_function, print_table
+
+MODES = ("put_item", "per_update", "buffered")
+
+
+def write_burst(lambda_function, mode, chat_id, count):
+    for index in range(count):
+        text = f"https://www.youtube.com/watch?v=benchmark{index:04d} medium"
+        if mode == "put_item":
+            lambda_function.MESSAGES_TABLE.put_item(Item={
+                'chat_id': str(chat_id),
+                'timestamp': lambda_function.datetime.utcnow().isoformat(),
+                'message': text,
+                'first_name': "Bench",
+                'last_name': None})
+        else:
+            lambda_function.save_message_to_dynamodb(chat_id, text, "Bench")
+            if mode == "per_update":
+                lambda_function.flush_message_history()
+    lambda_function.flush_message_history()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bursts", type=int, nargs="+", default=[1, 10, 100, 1000], help="messages per burst")
+    parser.add_argument("--rtt-ms", type=float, default=0, help="simulated round trip of each DynamoDB request")
+    args = parser.parse_args()
+
+    lambda_function = load_lambda_function(aws_stand_in=True)
+    create_stand_in_resources(lambda_function)
+    requests = {"count": 0}
+
+    def count_request(**kwargs):
+        requests["count"] += 1
+        if args.rtt_ms:
+            time.sleep(args.rtt_ms / 1000)
+
+    lambda_function.DYNAMODB.meta.client.meta.events.register('before-send.dynamodb', count_request)
+
+    rows = []
+    for burst in args.bursts:
+        for chat_id, mode in enumerate(MODES):
+            requests["count"] = 0
+            start = time.time()
+            write_burst(lambda_function, mode, chat_id + burst * 10, burst)
+            seconds = time.time() - start
+            rows.append([burst, mode, requests["count"], seconds, burst / seconds])
+
+    print_table(["burst", "mode", "requests", "seconds", "messages/s"], rows)
+
+
+if __name__ == "__main__":
+    main()
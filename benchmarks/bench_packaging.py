@@ -0,0 +1,71 @@
+"""
+CPU time and output size of each packaging of the S3 path (package_for_s3):
+- raw: the media uploaded as is
+- stored: uncompressed zip
+- deflate: deflate zip, as before the packaging stage
+- auto: deflate only if the compressibility samples pay off, stored zip otherwise
+
+The media are generated with ffmpeg (H.264/AAC video and MP3 audio of the given sizes) unless files are given.
+
+    python benchmarks/bench_packaging.py --sizes 10 50 100
+    python benchmarks/bench_packaging.py --media downloaded.mp4 song.mp3
+"""
+import os
+import time
+import zipfile
+import argparse
+import tempfile
+
+from common import find_ffmpeg, load_lambda_function, make_audio, make_video, print_table
+
+VIDEO_KBPS = 8000
+AUDIO_KBPS = 192
+
+
+def package(lambda_function, mode, file_path):
+    """
+    Package the file like the S3 path does, return the path to upload
+    """
+    if mode == "deflate":
+        return lambda_function.zip_file(file_path, compression=zipfile.ZIP_DEFLATED)
+    lambda_function.S3_PACKAGING = mode
+    return lambda_function.package_for_s3(file_path)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50], help="generated media sizes in MB")
+    parser.add_argument("--media", nargs="+", help="benchmark these files instead of generated ones")
+    parser.add_argument("--ffmpeg", help="ffmpeg used to generate the media")
+    args = parser.parse_args()
+
+    lambda_function = load_lambda_function()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        media = args.media
+        if not media:
+            ffmpeg = find_ffmpeg(args.ffmpeg)
+            media = []
+            for size_mb in args.sizes:
+                media.append(make_video(ffmpeg, os.path.join(temp_dir, f"video_{size_mb}MB.mp4"),
+                                        size_mb * 8000 // (VIDEO_KBPS + 128), video_kbps=VIDEO_KBPS))
+                media.append(make_audio(ffmpeg, os.path.join(temp_dir, f"audio_{size_mb}MB.mp3"),
+                                        size_mb * 8000 // AUDIO_KBPS, "libmp3lame", kbps=AUDIO_KBPS))
+
+        rows = []
+        for file_path in media:
+            size = os.path.getsize(file_path)
+            for mode in ("raw", "stored", "deflate", "auto"):
+                start, cpu_start = time.time(), time.process_time()
+                output_path = package(lambda_function, mode, file_path)
+                cpu, wall = time.process_time() - cpu_start, time.time() - start
+                output_size = os.path.getsize(output_path)
+                if output_path != file_path:
+                    os.remove(output_path)
+                rows.append([os.path.basename(file_path), mode, cpu, wall, size / (1024 * 1024),
+                             output_size / (1024 * 1024), output_size / size])
+
+    print_table(["media", "mode", "CPU s", "wall s", "input MB", "output MB", "ratio"], rows)
+
+
+if __name__ == "__main__":
+    main()
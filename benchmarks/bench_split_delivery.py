@@ -0,0 +1,88 @@
+"""
+End-to-end delivery time of files over the Telegram limit (send_video_or_link), against a fake Telegram
+Bot API endpoint and an S3 stand-in (moto in-process, or MinIO through AWS_ENDPOINT_URL_S3):
+- split: the file cut at keyframes into parts sent as media groups in Telegram (LARGE_FILE_DELIVERY "split")
+- link: the file packaged, uploaded to S3 and sent as a presigned link (LARGE_FILE_DELIVERY "link")
+
+The videos are generated with ffmpeg. --telegram-mbps and --s3-mbps limit the bandwidth of each
+connection, since the local stand-ins have no network. The stages are the ones of the download job metrics.
+
+    python benchmarks/bench_split_delivery.py --sizes 60 120 400 --telegram-mbps 100 --s3-mbps 200
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from common import (FakeTelegram, create_stand_in_resources, find_ffmpeg, load_lambda_function, make_video,
+                    median, print_table, use_fake_telegram)
+
+MODES = ("split", "link")
+VIDEO_KBPS = 8000
+STAGES = ("split", "package", "s3_upload", "telegram_upload", "telegram_message")
+
+
+def deliver(lambda_function, mode, video_path, work_dir):
+    """
+    Deliver a copy of the video (send_video_or_link deletes it), return the total time and the job stages
+    """
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    file_path = shutil.copy(video_path, work_dir)
+    lambda_function.LARGE_FILE_DELIVERY = mode
+    metrics = lambda_function.JobMetrics("download", Delivery="failed")
+    lambda_function.JOB_METRICS["current"] = metrics
+    try:
+        start = time.time()
+        lambda_function.send_video_or_link(1, file_path, "Bench")
+        seconds = time.time() - start
+    finally:
+        lambda_function.JOB_METRICS["current"] = None
+    if metrics.dimensions["Delivery"] != mode:
+        raise Exception(f"{os.path.basename(video_path)} delivered by {metrics.dimensions['Delivery']}, not {mode}")
+    return seconds, {name: stage["seconds"] for name, stage in metrics.stages.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[60, 120, 250], help="video sizes in MB (over 50)")
+    parser.add_argument("--telegram-mbps", type=float, default=100, help="upload bandwidth to Telegram per connection")
+    parser.add_argument("--s3-mbps", type=float, default=200, help="upload bandwidth to S3 per connection (0: none)")
+    parser.add_argument("--runs", type=int, default=1, help="deliveries per size and mode")
+    parser.add_argument("--ffmpeg", help="ffmpeg used to generate the videos and split them")
+    args = parser.parse_args()
+
+    lambda_function = load_lambda_function(aws_stand_in=True)
+    create_stand_in_resources(lambda_function)
+    lambda_function.FFMPEG_PATH = find_ffmpeg(args.ffmpeg)
+
+    def throttle_s3(request, **kwargs):
+        size = int(request.headers.get('Content-Length') or 0)
+        if args.s3_mbps and size:
+            time.sleep(size * 8 / (args.s3_mbps * 1e6))
+
+    lambda_function.get_aws_client('s3').meta.events.register('before-send.s3', throttle_s3)
+
+    rows = []
+    with FakeTelegram(upload_mbps=args.telegram_mbps) as fake, tempfile.TemporaryDirectory() as temp_dir:
+        use_fake_telegram(lambda_function, fake.url)
+        for size_mb in args.sizes:
+            video_path = make_video(lambda_function.FFMPEG_PATH, os.path.join(temp_dir, f"video_{size_mb}MB.mp4"),
+                                    size_mb * 8000 // (VIDEO_KBPS + 128), video_kbps=VIDEO_KBPS)
+            actual_mb = os.path.getsize(video_path) / (1024 * 1024)
+            for mode in MODES:
+                results = []
+                for _ in range(args.runs):
+                    fake.requests.clear()
+                    seconds, stages = deliver(lambda_function, mode, video_path, os.path.join(temp_dir, "delivery"))
+                    results.append((seconds, stages, len(fake.requests)))
+                rows.append([actual_mb, mode, median([result[0] for result in results]),
+                             *[median([result[1].get(stage, 0) for result in results]) for stage in STAGES],
+                             results[0][2]])
+
+    print_table(["file MB", "delivery", "total s", *[f"{stage} s" for stage in STAGES], "Telegram requests"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Peak memory of a media upload to Telegram, against a local fake Bot API endpoint:
+- buffered: the file read in memory and encoded by urllib3 (fields=), as before the streaming upload
+- streamed: build_multipart_body, reading the file from disk in TELEGRAM_UPLOAD_CHUNK_SIZE chunks
+
+Each upload runs in a fresh process, since the peak RSS only ever grows.
+
+    python benchmarks/bench_telegram_upload.py --sizes 10 25 45
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+from common import FakeTelegram, load_lambda_function, peak_rss_mb, print_table, use_fake_telegram
+
+MODES = ("buffered", "streamed")
+
+
+def upload(mode, file_path, telegram_url):
+    lambda_function = load_lambda_function()
+    use_fake_telegram(lambda_function, telegram_url)
+    baseline = peak_rss_mb()
+    file_name = os.path.basename(file_path)
+
+    if mode == "buffered":
+        with open(file_path, 'rb') as video:
+            video_data = video.read()
+        fields = {"chat_id": "1", "video": (file_name, video_data, "video/mp4")}
+        response = lambda_function.telegram_request("sendVideo", fields=fields)
+    else:
+        body_factory, headers = lambda_function.build_multipart_body(
+            {"chat_id": "1"}, {"video": (file_name, file_path, "video/mp4")})
+        response = lambda_function.telegram_request("sendVideo", body_factory=body_factory, headers=headers)
+
+    if response.status != 200:
+        sys.exit(f"Upload failed with status {response.status}")
+    print(json.dumps({"baseline_mb": baseline, "peak_mb": peak_rss_mb()}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 25, 45], help="file sizes in MB")
+    parser.add_argument("--child", nargs=3, metavar=("MODE", "FILE", "URL"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        upload(*args.child)
+        return
+
+    rows = []
+    with FakeTelegram() as fake, tempfile.TemporaryDirectory() as temp_dir:
+        for size_mb in args.sizes:
+            file_path = os.path.join(temp_dir, f"video_{size_mb}.mp4")
+            with open(file_path, 'wb') as f:
+                for _ in range(size_mb):
+                    f.write(os.urandom(1024 * 1024))
+            for mode in MODES:
+                output = subprocess.run([sys.executable, __file__, "--child", mode, file_path, fake.url],
+                                        capture_output=True, text=True, check=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                rows.append([size_mb, mode, result["baseline_mb"], result["peak_mb"],
+                             result["peak_mb"] - result["baseline_mb"]])
+
+    print_table(["file MB", "mode", "RSS before MB", "peak RSS MB", "upload overhead MB"], rows)
+
+
+if __name__ == "__main__":
+    main()
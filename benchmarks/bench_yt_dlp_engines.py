@@ -0,0 +1,91 @@
+"""
+Startup latency of the two yt-dlp engines, for the version check (/info) and a metadata extraction
+(the preflight) of a media served by a local HTTP server:
+- subprocess: one yt-dlp process per call, which imports yt-dlp and its extractors every time
+- inprocess: yt-dlp imported once by the container, the first call pays the import (cold), the next ones don't
+
+Each engine runs in a fresh process, like a cold Lambda container. --yt-dlp must be the zipapp of the layer
+(executable, and importable for the in-process engine).
+
+    python benchmarks/bench_yt_dlp_engines.py --yt-dlp /opt/bin/yt-dlp --runs 5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import functools
+import subprocess
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from common import cpu_seconds, load_lambda_function, median, print_table
+
+ENGINES = ("subprocess", "inprocess")
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def measure(engine, yt_dlp_path, url, runs):
+    lambda_function = load_lambda_function()
+    lambda_function.YT_DLP_ENGINE = engine
+    lambda_function.YT_DLP_PATH = yt_dlp_path
+    lambda_function.YT_DLP_CACHE_DIR = tempfile.mkdtemp(prefix="yt_dlp_cache_")
+    lambda_function.YT_DLP_CACHE_STATS["restored"] = True  # No S3 snapshot to restore
+
+    results = {"version": [], "extract": [], "cpu": []}
+    for _ in range(runs):
+        cpu_start = cpu_seconds()
+        start = time.time()
+        lambda_function.YT_DLP_VERSION["version"] = None
+        if lambda_function.get_ytdlp_version() is None:
+            sys.exit("yt-dlp version check failed")
+        results["version"].append(time.time() - start)
+
+        start = time.time()
+        lambda_function.run_yt_dlp_extract(["--no-playlist", url])
+        results["extract"].append(time.time() - start)
+        results["cpu"].append(cpu_seconds() - cpu_start)
+    print(json.dumps(results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--yt-dlp", default="/opt/bin/yt-dlp", help="yt-dlp zipapp")
+    parser.add_argument("--runs", type=int, default=5, help="calls per engine in the same process")
+    parser.add_argument("--child", nargs=2, metavar=("ENGINE", "URL"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure(args.child[0], args.yt_dlp, args.child[1], args.runs)
+        return
+
+    with tempfile.TemporaryDirectory() as media_dir:
+        with open(os.path.join(media_dir, "media.mp4"), 'wb') as f:
+            f.write(os.urandom(1024 * 1024))
+        server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=media_dir))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/media.mp4"
+
+        rows = []
+        for engine in ENGINES:
+            output = subprocess.run([sys.executable, __file__, "--yt-dlp", args.yt_dlp, "--runs", str(args.runs),
+                                     "--child", engine, url], capture_output=True, text=True)
+            if output.returncode != 0:
+                sys.exit(f"{engine} engine failed: {output.stderr[-2000:]}")
+            results = json.loads(output.stdout.strip().splitlines()[-1])
+            rows.append([engine, results["version"][0], median(results["version"][1:]),
+                         results["extract"][0], median(results["extract"][1:]),
+                         results["cpu"][0], median(results["cpu"][1:])])
+        server.shutdown()
+
+    print_table(["engine", "version cold s", "version warm s", "extract cold s", "extract warm s",
+                 "CPU cold s", "CPU warm s"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+Shared helpers of the benchmark scripts: loading lambda_function against local stand-ins,
+a fake Telegram Bot API endpoint, test media generation and result tables
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import statistics
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+BENCHMARK_BUCKETS = ("yt-downloaded-videos", "yt-cookies")
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def load_lambda_function(aws_stand_in=False):
+    """
+    Import lambda_function. With aws_stand_in, S3 and DynamoDB are served by moto in-process unless
+    AWS_ENDPOINT_URL_S3 / DYNAMODB_ENDPOINT_URL point to local services (MinIO, DynamoDB Local...).
+    The stand-in must start before the import, which creates the DynamoDB resource
+    """
+    if aws_stand_in and not (os.environ.get("AWS_ENDPOINT_URL_S3") and os.environ.get("DYNAMODB_ENDPOINT_URL")):
+        try:
+            from moto import mock_aws
+        except ImportError:
+            sys.exit("Install moto, or set AWS_ENDPOINT_URL_S3 and DYNAMODB_ENDPOINT_URL to local services")
+        for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+            os.environ.setdefault(name, "benchmark")
+        mock_aws().start()
+    import lambda_function
+    lambda_function.logger.setLevel("WARNING")
+    lambda_function.LOCAL_METRICS = False
+    return lambda_function
+
+
+def create_stand_in_resources(lambda_function):
+    """
+    Create the buckets and tables the bot expects, skipping the ones that already exist
+    """
+    s3 = lambda_function.get_aws_client('s3')
+    for bucket in BENCHMARK_BUCKETS:
+        try:
+            s3.create_bucket(Bucket=bucket)
+        except s3.exceptions.ClientError:
+            pass
+    client = lambda_function.DYNAMODB.meta.client
+    tables = {
+        lambda_function.MESSAGES_TABLE.name: [("chat_id", "HASH"), ("timestamp", "RANGE")],
+        lambda_function.STATE_TABLE.name: [("pk", "HASH")],
+        lambda_function.FILES_TABLE.name: [("folder", "HASH"), ("file_name", "RANGE")]}
+    indexes = {lambda_function.STATE_TABLE.name: {
+        'IndexName': lambda_function.DOWNLOAD_CACHE_INDEX,
+        'KeySchema': [{'AttributeName': "cache", 'KeyType': "HASH"},
+                      {'AttributeName': "last_access", 'KeyType': "RANGE"}],
+        'Projection': {'ProjectionType': "INCLUDE", 'NonKeyAttributes': ["s3_key", "size"]}}}
+    existing = client.list_tables()["TableNames"]
+    for name, keys in tables.items():
+        if name not in existing:
+            attributes = [{'AttributeName': key, 'AttributeType': 'S'} for key, _ in keys]
+            extra = {}
+            if name in indexes:
+                attributes.extend([{'AttributeName': "cache", 'AttributeType': 'S'},
+                                   {'AttributeName': "last_access", 'AttributeType': 'N'}])
+                extra['GlobalSecondaryIndexes'] = [indexes[name]]
+            client.create_table(
+                TableName=name,
+                KeySchema=[{'AttributeName': key, 'KeyType': key_type} for key, key_type in keys],
+                AttributeDefinitions=attributes,
+                BillingMode='PAY_PER_REQUEST',
+                **extra)
+
+
+class FakeTelegram:
+    """
+    Local stand-in of the Telegram Bot API: request bodies are read and discarded (optionally at a limited
+    rate per connection, like a real upload), and every method answers ok. Use as a context manager,
+    then point TELEGRAM_API_URL at .url
+    """
+
+    def __init__(self, upload_mbps=None):
+        self.upload_mbps = upload_mbps
+        self.requests = []
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                start = time.time()
+                remaining = int(self.headers.get('Content-Length') or 0)
+                received = 0
+                while remaining > 0:
+                    chunk = self.rfile.read(min(READ_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    received += len(chunk)
+                    if fake.upload_mbps:
+                        delay = received * 8 / (fake.upload_mbps * 1e6) - (time.time() - start)
+                        if delay > 0:
+                            time.sleep(delay)
+                method = self.path.rsplit('/', 1)[-1]
+                with fake.lock:
+                    fake.requests.append((method, received))
+                result = [{"message_id": 1}] if method == "sendMediaGroup" else {
+                    "message_id": 1, "video": {"file_id": "benchmark"}}
+                body = json.dumps({"ok": True, "result": result}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def use_fake_telegram(lambda_function, telegram_url):
+    """
+    Send the bot's Telegram requests to the fake endpoint, with a dummy token instead of Secrets Manager
+    """
+    lambda_function.TELEGRAM_API_URL = telegram_url
+    lambda_function.BOT_TOKEN_CACHE["token"] = "benchmark"
+    lambda_function.BOT_TOKEN_CACHE["expires_at"] = float("inf")
+
+
+def find_ffmpeg(path=None):
+    """
+    Return the ffmpeg to use: the given path, $FFMPEG, the one on the PATH or the Lambda layer's
+    """
+    for candidate in (path, os.environ.get("FFMPEG"), shutil.which("ffmpeg"), "/opt/bin/ffmpeg"):
+        if candidate and os.path.exists(candidate):
+            return candidate
+    sys.exit("ffmpeg not found, pass --ffmpeg or set $FFMPEG")
+
+
+def make_video(ffmpeg, path, seconds, video_kbps=2500, audio_kbps=128, size="1280x720"):
+    """
+    Encode a test video (moving pattern and tone, H.264/AAC), compressed like a real download
+    """
+    if not os.path.exists(path):
+        subprocess.run([
+            ffmpeg, "-y", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"testsrc2=size={size}:rate=25:duration={seconds}",
+            "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+            "-c:v", "libx264", "-preset", "ultrafast", "-b:v", f"{video_kbps}k", "-g", "50",
+            "-c:a", "aac", "-b:a", f"{audio_kbps}k", "-movflags", "+faststart", path], check=True)
+    return path
+
+
+def make_audio(ffmpeg, path, seconds, codec, kbps=128):
+    """
+    Encode a test audio stream (noise, which doesn't compress away) with the given ffmpeg codec
+    """
+    if not os.path.exists(path):
+        subprocess.run([
+            ffmpeg, "-y", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"anoisesrc=color=pink:duration={seconds}:sample_rate=48000",
+            "-ac", "2", "-c:a", codec, "-b:a", f"{kbps}k", path], check=True)
+    return path
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on Linux
+
+
+def cpu_seconds():
+    """
+    CPU time (user + system) of this process and of its finished children
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def median(values):
+    return statistics.median(values) if values else None
+
+
+def print_table(headers, rows):
+    cells = [[str(header) for header in headers]] + [[format_cell(value) for value in row] for row in rows]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(headers))]
+    for index, row in enumerate(cells):
+        print("  ".join(cell.rjust(width) for cell, width in zip(row, widths)))
+        if index == 0:
+            print("  ".join("-" * width for width in widths))
+
+
+def format_cell(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.3f}" if abs(value) < 100 else f"{value:.1f}"
+    return str(value)
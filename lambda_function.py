@@ -1,11 +1,23 @@
 import os
+import re
 import json
+import hashlib
 import subprocess
 import urllib3
 import boto3
 import zipfile
+import zlib
+import fnmatch
 import shutil
+import sys
 import tempfile
+import time
+import uuid
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 from botocore.exceptions import ClientError
 from botocore.config import Config
 from datetime import datetime
@@ -16,22 +28,37 @@ REGION_NAME = "us-east-1"
 S3_YT_VIDEOS_BUCKET_NAME = "yt-downloaded-videos"
 S3_COOKIES_BUCKET_NAME = "yt-cookies"
 S3_COOKIES_KEY = "youtube_cookies.txt"
+COOKIE_CACHE_TTL_SECONDS = 300  # The cached cookies are revalidated against S3 (by ETag) after this delay
 YT_DLP_PATH = "/opt/bin/yt-dlp"
+YT_DLP_ENGINE = "inprocess"  # "inprocess" (yt-dlp imported once from its zipapp) or "subprocess" (one process per job)
 FFMPEG_PATH = "/opt/bin/ffmpeg"
 DENO_PATH = "/opt/bin/deno"
 BOT_SECRET_NAME = "Telegram-bot-token"
 BOT_SECRET_KEY = "bot_token"
-DYNAMODB = boto3.resource('dynamodb')
+BOT_TOKEN_TTL_SECONDS = 3600  # How long a warm container keeps the bot token before fetching it again
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")  # e.g. a local Bot API server
+AWS_CLIENT_CONFIG = Config(
+    max_pool_connections=20,  # Enough for parallel S3 part uploads
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    connect_timeout=5,
+    read_timeout=60)
+DYNAMODB_ENDPOINT_URL = os.environ.get("DYNAMODB_ENDPOINT_URL")  # e.g. http://localhost:8000 for DynamoDB Local
+DYNAMODB = boto3.resource('dynamodb', config=AWS_CLIENT_CONFIG, endpoint_url=DYNAMODB_ENDPOINT_URL)
 MESSAGES_TABLE = DYNAMODB.Table('telegram_messages')
+HISTORY_BUFFER_SIZE = 25  # Buffered messages are flushed when this many are waiting (BatchWriteItem maximum)
+HISTORY_WRITE_MAX_ATTEMPTS = 5  # Attempts for the items DynamoDB leaves unprocessed, with exponential backoff
+HISTORY_TTL_DAYS = None  # Set e.g. 365 (and enable TTL on "expires_at") to expire old messages
+STATE_TABLE = DYNAMODB.Table('yt_dl_bot_state')  # Caches and indexes, partition key "pk", TTL attribute "expires_at"
+FILES_TABLE = DYNAMODB.Table('yt_dl_bot_files')  # Manifest of the users' folders, keys "folder" and "file_name"
 
 HELP_MESSAGE = """
 📚 Available commands:
 
 /start - Start the bot
-/list - List all your videos on the server
-/delete filename.zip - Delete a specific video
-/empty - Delete all videos
-/history - Show your message history
+/list - List all your videos on the server (/list size to sort by size, /list 2 for the next page)
+/delete filename.zip - Delete a specific video (wildcards allowed, e.g. /delete *.zip)
+/empty - Delete all videos (/empty older-than 7d to keep the recent ones)
+/history - Show your latest messages (/history next for older ones)
 /info - Display yt-dlp version
 /test - Test the download pipeline
 /help - Display this help
@@ -39,12 +66,21 @@ HELP_MESSAGE = """
 To download a YouTube video:
 "[URL] [resolution]"
 
+To download a whole playlist (add "zip" to get a single archive):
+"[playlist URL] [resolution] [zip]"
+
+To download only a part of a video (start-end, as [h:]m:s or seconds):
+"[URL] [resolution] 12:30-13:10"
+
 Available resolutions:
 • low - low quality (240p)
 • medium - medium quality (480p)
 • high - high quality (720p)
 • veryhigh - very high quality (1080p)
 • mp3 - audio only (MP3 format)
+• m4a - audio only, original AAC stream (faster, no conversion)
+• opus - audio only, original Opus stream (faster, no conversion)
+• fit - best quality that can still be sent in Telegram (under 50 MB)
 
 Example: "https://www.youtube.com/watch?v=example medium"
     """
@@ -54,21 +90,176 @@ FORMATS = {
     "medium": "bestvideo[height<=480][ext=mp4]+bestaudio",
     "high": "bestvideo[height<=720][ext=mp4]+bestaudio",
     "veryhigh": "bestvideo[height<=1080][ext=mp4]+bestaudio",
-    "mp3": "bestaudio"}
+    "mp3": "bestaudio",
+    "m4a": "bestaudio[ext=m4a]",
+    "opus": "bestaudio[acodec=opus]"}
+
+# Audio only resolutions and the extension of their file. m4a and opus are the native YouTube audio streams,
+# remuxed without conversion, mp3 is re-encoded with MP3_AUDIO_QUALITY
+AUDIO_EXTENSIONS = {"mp3": ".mp3", "m4a": ".m4a", "opus": ".opus"}
+MP3_AUDIO_QUALITY = "5"  # yt-dlp --audio-quality: VBR 0 (best) to 10 (worst), or a bitrate such as "192K"
+
+# Resolutions piped straight to S3, e.g. ["high", "veryhigh"]. A single-file selection is written to stdout by
+# yt-dlp, a video+audio selection (yt-dlp can't write merges to stdout) is muxed by ffmpeg as a fragmented MP4
+STREAMING_UPLOAD_RESOLUTIONS = []
+STREAMING_MUX_ARGS = ["-c", "copy", "-movflags", "frag_keyframe+empty_moov", "-f", "mp4"]
+STREAMING_STOP_TIMEOUT_SECONDS = 5  # Wait for a killed streaming process and its stderr reader
+
+# yt-dlp download settings are derived from the Lambda memory (which sets the vCPUs), the vCPU count and free /tmp
+LAMBDA_MEMORY_MB_PER_VCPU = 1769  # Lambda allocates one vCPU per 1769 MB of memory
+FRAGMENTS_PER_VCPU = 4  # Fragment downloads are mostly waiting on the network
+MAX_CONCURRENT_FRAGMENTS = 16
+MEMORY_MB_PER_FRAGMENT = 64  # Memory budget of each fragment being downloaded
+HTTP_CHUNK_SIZE = 10 * 1024 * 1024  # Smaller ranged requests avoid the throttling of long YouTube downloads
+TMP_SPACE_MARGIN = 4  # Fragments on disk at the same time must fit this many times in the free /tmp space
+DOWNLOAD_TUNING_OVERRIDES = {}  # Per resolution of FORMATS, e.g. {"veryhigh": {"concurrent_fragments": 8}}
+
+CLIP_PATTERN = re.compile(r"^(\d+(?::\d{1,2}){0,2})-(\d+(?::\d{1,2}){0,2})$")  # e.g. 12:30-13:10 or 1:02:03-1:02:40
+CLIP_FORCE_KEYFRAMES = False  # Re-encode around the cuts for exact clips (slower), else cuts snap to keyframes
+
+TELEGRAM_MAX_UPLOAD_MB = 50  # Bot API limit, bigger files are uploaded to S3 and sent as a link
+LARGE_FILE_DELIVERY = "link"  # "link" (S3 presigned link) or "split" (parts under the limit sent in Telegram)
+SPLIT_TARGET_MB = 45  # Parts are cut at keyframes, so they are aimed below the limit
+SPLIT_MAX_ATTEMPTS = 3  # Shorter parts are tried when a part still exceeds the limit
+SPLIT_UPLOAD_CONCURRENCY = 4  # Media groups uploaded at the same time
+MEDIA_GROUP_MAX_ITEMS = 10  # sendMediaGroup accepts 2 to 10 items
+FASTSTART_ARGS = "-movflags +faststart"  # Moves the MP4 index (moov) first, so playback starts while downloading
+THUMBNAIL_URL = "https://i.ytimg.com/vi/{video_id}/mqdefault.jpg"  # 320x180 JPEG, within the Bot API thumbnail limits
+FIT_RESOLUTION = "fit"  # Picks the best of FIT_RESOLUTIONS whose estimated size is under TELEGRAM_MAX_UPLOAD_MB
+FIT_RESOLUTIONS = ["veryhigh", "high", "medium", "low"]
+FIT_SIZE_MARGIN = 0.9  # Size estimates are approximate, keep some room under the limit
+PREFLIGHT_ENABLED = True  # Extract the metadata first (yt-dlp -J) to choose the delivery path before downloading
+PREFLIGHT_CACHE_TTL_SECONDS = 600  # Extracted metadata reused by the container (stream URLs expire after hours)
+PREFLIGHT_CACHE_MAX_ENTRIES = 100
+MP3_ESTIMATED_BYTES_PER_SECOND = 16000  # ~128 kbps, the MP3 is re-encoded so its source size doesn't apply
+
+PROGRESS_EDIT_INTERVAL_SECONDS = 3  # Minimum delay between two edits of the progress message (Telegram rate limits)
+PROGRESS_PREFIX = "[progress]"
+PROGRESS_TEMPLATE = (f"download:{PROGRESS_PREFIX} %(info.format_id)s %(progress.downloaded_bytes)s "
+                     "%(progress.total_bytes)s %(progress.total_bytes_estimate)s %(progress.speed)s %(progress.eta)s")
+POSTPROCESSING_STAGES = ("Merger", "ExtractAudio", "FixupM4a", "FixupM3u8", "FixupDuplicateMoov", "VideoRemuxer")
+
+TELEGRAM_MESSAGE_LIMIT = 4096  # Longer texts are split over several messages
+HISTORY_PAGE_SIZE = 25
+LIST_PAGE_SIZE = 50
+HISTORY_CURSOR_TTL_SECONDS = 3600  # How long /history next can continue from the previous page
+
+TELEGRAM_UPLOAD_CHUNK_SIZE = 1024 * 1024  # Files are streamed to Telegram in chunks of this size
+TELEGRAM_UPLOAD_ATTEMPTS = 3  # Streamed uploads are sent again on a connection error, up to this many times
+S3_MULTIPART_PART_SIZE = 16 * 1024 * 1024  # Part size of streamed S3 uploads (min 5 MB)
+S3_MULTIPART_MAX_INFLIGHT = 4  # Parts uploaded in parallel, which also bounds the memory used for buffering
+S3_MEDIA_DISPOSITION = "inline"  # Raw media links play in the browser ("inline") or download ("attachment")
+S3_DELETABLE_EXTENSIONS = ('.zip', '.mp4', '.mp3', '.m4a', '.opus')  # Files removed by /empty
+S3_DELETE_BATCH_SIZE = 1000  # DeleteObjects maximum
+S3_PACKAGING = "auto"  # "raw" (no archive), "stored" (uncompressed zip) or "auto" (deflate zip only if it pays off)
+COMPRESSIBILITY_SAMPLES = 4  # Number of chunks sampled across the file to decide if deflate is worth it
+COMPRESSIBILITY_SAMPLE_SIZE = 256 * 1024
+COMPRESSIBILITY_THRESHOLD = 0.9  # Deflate only if the samples shrink below this ratio
+DOWNLOAD_CACHE_ENABLED = True  # Share downloads of the same video and resolution between all chats
+DOWNLOAD_CACHE_PREFIX = "_cache/"  # Keep an S3 lifecycle rule expiring this prefix after DOWNLOAD_CACHE_TTL_DAYS
+DOWNLOAD_CACHE_TTL_DAYS = 7
+DOWNLOAD_CACHE_MAX_BYTES = 20 * 1024 ** 3  # Least recently used entries are evicted above this size
+DOWNLOAD_CACHE_INDEX = "cache-last_access"  # GSI of yt_dl_bot_state listing the cache entries by last access
+TELEGRAM_FILE_ID_REUSE = True  # Resend media already uploaded to Telegram by its file_id
+TELEGRAM_SEND_METHODS = {"video": "sendVideo", "audio": "sendAudio", "document": "sendDocument"}
+TELEGRAM_MEDIA_TYPES = {".mp4": "video", ".mp3": "audio", ".m4a": "audio"}  # Other files (e.g. .opus) are documents
+YOUTUBE_ID_PATTERN = re.compile(r"(?:v=|youtu\.be/|shorts/|embed/|live/)([A-Za-z0-9_-]{11})")
+UPDATE_DEDUP_TTL_SECONDS = 86400  # How long a Telegram update_id is remembered (Telegram retries for hours at most)
+JOB_LOCK_TTL_SECONDS = 900  # Identical jobs are dropped while one is in flight, at most the Lambda max duration
+METRICS_NAMESPACE = "YTDownloader_app"
+METRIC_COMMANDS = ("/start", "/help", "/list", "/delete", "/empty", "/history", "/info", "/test")  # Command dimension
+LOCAL_METRICS = "AWS_LAMBDA_FUNCTION_NAME" not in os.environ  # Outside Lambda, jobs also print a stage breakdown
+LATENCY_SAMPLES_SIZE = 1000  # Latency samples kept per metric and command to log p50/p99 of the container
+PLAYLIST_MAX_ITEMS = 50  # Entries downloaded from a playlist
+PLAYLIST_CONCURRENCY = 10  # Playlist entries processed at the same time, each in its own Lambda invocation
+PLAYLIST_JOB_TTL_SECONDS = 86400
+PLAYLIST_ENTRY_MAX_ATTEMPTS = 3  # An entry invocation and Lambda's async retries of it (MaximumRetryAttempts 2)
+PLAYLIST_ENTRY_RETRY_GRACE_SECONDS = 600  # Time for Lambda to retry a timed out entry before it counts as failed
+PLAYLIST_ENTRY_DEADLINE_MARGIN_SECONDS = 10  # The last attempt of an entry gives up this long before its timeout
+MEDIA_CONTENT_TYPES = {
+    ".mp4": "video/mp4",
+    ".mp3": "audio/mpeg",
+    ".m4a": "audio/mp4",
+    ".opus": "audio/ogg",
+    ".zip": "application/zip"}
 
 WORKING_DIR = "/tmp"  # AWS Lambda has write permissions in /tmp
 os.makedirs(WORKING_DIR, exist_ok=True)
-HTTP = urllib3.PoolManager()
+COOKIE_CACHE_PATH = os.path.join(WORKING_DIR, "youtube_cookies_cache.txt")
+YT_DLP_CACHE_DIR = os.path.join(WORKING_DIR, "yt_dlp_cache")  # yt-dlp --cache-dir (player JS, signature solutions)
+YT_DLP_CACHE_SNAPSHOT_PREFIX = "_system/yt_dlp_cache/"  # S3 snapshots restored on cold start, one per yt-dlp version
+YT_DLP_CACHE_MAX_BYTES = 50 * 1024 * 1024  # Oldest files are evicted above this size
+HTTP_POOL_MAXSIZE = 10  # Connections kept per host, for the concurrent uploads to Telegram
+HTTP = urllib3.PoolManager(maxsize=HTTP_POOL_MAXSIZE)
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-cloudwatch = boto3.client('cloudwatch')
+
+# boto3 clients, created once per (service, config) and reused by all invocations of a warm container
+AWS_CLIENTS = {}
+AWS_CLIENTS_STATS = {"created": 0, "reused": 0}
+
+# Download cache counters and yt-dlp version, kept for the lifetime of the container
+DOWNLOAD_CACHE_STATS = {"hits": 0, "misses": 0}
+YT_DLP_VERSION = {"version": None}
+
+# yt-dlp cache directory state and hit counters (a run that adds no file to the cache is a hit). The counts not
+# yet added to DynamoDB and the files of the last snapshot are persisted at the end of the invocation
+YT_DLP_CACHE_STATS = {"restored": False, "hits": 0, "misses": 0, "unsaved_hits": 0, "unsaved_misses": 0,
+                      "snapshot_files": {}}
+
+# yt-dlp module of the in-process engine, imported on first use
+YT_DLP_MODULE = {"module": None, "error": None}
+
+# Cookies cache, the file itself lives at COOKIE_CACHE_PATH
+COOKIE_CACHE = {"etag": None, "checked_at": 0, "fetch_seconds": None, "hits": 0, "revalidations": 0,
+                "downloads": 0, "saved_seconds": 0}
+COOKIE_CACHE_LOCK = threading.Lock()
+
+# Metadata extracted by the preflight, by video ID (or URL), oldest first
+PREFLIGHT_CACHE = {}
+
+# Messages waiting to be written to the history table
+HISTORY_BUFFER = []
+
+# Stages of the download job being processed by this invocation
+JOB_METRICS = {"current": None}
+
+# Recent latencies in milliseconds, by (metric, command)
+LATENCY_SAMPLES = {}
+
+# Bot token cache, shared by all invocations running in the same (warm) container
+BOT_TOKEN_CACHE = {"token": None, "expires_at": 0, "hits": 0, "misses": 0}
 
 
-def get_secret_bot_token():
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=REGION_NAME)
+def get_aws_client(service_name, **config_overrides):
+    """
+    Return the shared boto3 client for a service, creating it on first use.
+    Keyword arguments are botocore Config options merged over AWS_CLIENT_CONFIG (e.g. signature_version='s3v4', region_name)
+    """
+    registry_key = (service_name, tuple(sorted(config_overrides.items())))
+    client = AWS_CLIENTS.get(registry_key)
+    if client is not None:
+        AWS_CLIENTS_STATS["reused"] += 1
+        return client
+
+    config = AWS_CLIENT_CONFIG.merge(Config(**config_overrides)) if config_overrides else AWS_CLIENT_CONFIG
+    client = boto3.client(service_name, config=config)
+    AWS_CLIENTS[registry_key] = client
+    AWS_CLIENTS_STATS["created"] += 1
+    logger.info(f"Created boto3 client for {service_name} ({len(AWS_CLIENTS)} clients in registry)")
+    return client
+
+
+def get_secret_bot_token(force_refresh=False):
+    """
+    Return the bot token, fetching it from Secrets Manager only when the cached one is missing or expired
+    """
+    if not force_refresh and BOT_TOKEN_CACHE["token"] and time.time() < BOT_TOKEN_CACHE["expires_at"]:
+        BOT_TOKEN_CACHE["hits"] += 1
+        return BOT_TOKEN_CACHE["token"]
+
+    BOT_TOKEN_CACHE["misses"] += 1
+    client = get_aws_client('secretsmanager', region_name=REGION_NAME)
 
     try:
         get_secret_value_response = client.get_secret_value(
@@ -81,52 +272,412 @@ def get_secret_bot_token():
     secret_string = get_secret_value_response['SecretString']
     secret = json.loads(secret_string)
 
-    return secret[BOT_SECRET_KEY]
+    BOT_TOKEN_CACHE["token"] = secret[BOT_SECRET_KEY]
+    BOT_TOKEN_CACHE["expires_at"] = time.time() + BOT_TOKEN_TTL_SECONDS
+    return BOT_TOKEN_CACHE["token"]
+
+
+def build_multipart_body(fields, files):
+    """
+    Build a multipart/form-data body that streams files from disk instead of loading them in memory.
+    fields: {name: value} text fields, files: {name: (file_name, file_path, content_type)}
+    Return a factory yielding the body chunks and the request headers (with the exact Content-Length)
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        header = (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+                  f'{value}\r\n').encode('utf-8')
+        parts.append((header, None))
+    for name, (file_name, file_path, content_type) in files.items():
+        quoted_name = file_name.replace('"', '%22')
+        header = (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{quoted_name}"\r\n'
+                  f'Content-Type: {content_type}\r\n\r\n').encode('utf-8')
+        parts.append((header, file_path))
+    closing = f'--{boundary}--\r\n'.encode('utf-8')
+
+    content_length = len(closing)
+    for header, file_path in parts:
+        content_length += len(header)
+        if file_path:
+            content_length += os.path.getsize(file_path) + 2  # file content followed by CRLF
+
+    def body_factory():
+        for header, file_path in parts:
+            yield header
+            if file_path:
+                with open(file_path, 'rb') as f:
+                    while True:
+                        chunk = f.read(TELEGRAM_UPLOAD_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        yield chunk
+                yield b'\r\n'
+        yield closing
+
+    headers = {
+        'Content-Type': f'multipart/form-data; boundary={boundary}',
+        'Content-Length': str(content_length)}
+    return body_factory, headers
+
+
+def telegram_request(api_method, body_factory=None, **request_kwargs):
+    """
+    POST to the Telegram Bot API, refreshing the cached bot token once if Telegram answers 401.
+    A streamed body is passed as body_factory so that it can be produced again for the retries: urllib3
+    would resend the same, already consumed, generator, so its retries are disabled and connection errors
+    are retried here, up to TELEGRAM_UPLOAD_ATTEMPTS
+    """
+    refresh_token = False
+    for attempt in range(TELEGRAM_UPLOAD_ATTEMPTS):
+        if body_factory:
+            request_kwargs.update(body=body_factory(), retries=False)
+        url = f"{TELEGRAM_API_URL}/bot{get_secret_bot_token(force_refresh=refresh_token)}/{api_method}"
+        try:
+            response = HTTP.request('POST', url, **request_kwargs)
+        except urllib3.exceptions.HTTPError as e:
+            if not body_factory or attempt == TELEGRAM_UPLOAD_ATTEMPTS - 1:
+                raise
+            logger.warning(f"Telegram {api_method} failed ({e}), sending the body again")
+            continue
+        if response.status != 401 or refresh_token:
+            break
+        refresh_token = True
+        logger.warning(f"Telegram {api_method} returned 401, refreshing the bot token")
+    return response
+
+
+def telegram_length(text):
+    return len(text.encode('utf-16-le')) // 2  # Telegram counts UTF-16 code units
+
+
+def split_message(message, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Split a text into chunks Telegram accepts, on line boundaries when possible
+    """
+    pieces = []
+    for line in message.splitlines(keepends=True):
+        # A longer line is cut, limit // 2 characters always fit in limit UTF-16 code units
+        while telegram_length(line) > limit:
+            pieces.append(line[:limit // 2])
+            line = line[limit // 2:]
+        pieces.append(line)
+
+    chunks = [""]
+    for piece in pieces:
+        if telegram_length(chunks[-1] + piece) > limit:
+            chunks.append("")
+        chunks[-1] += piece
+    return [chunk for chunk in chunks if chunk]
 
 
 def send_message(chat_id, message):
-    url = f"https://api.telegram.org/bot{get_secret_bot_token()}/sendMessage"
-    data = {"chat_id": chat_id, "text": message}
+    """
+    Send a text message, split if it is over Telegram's limit, and return the message_id of its
+    first part (None if Telegram didn't accept it)
+    """
+    message_id = None
+    chunks = split_message(message) if telegram_length(message) > TELEGRAM_MESSAGE_LIMIT else [message]
+    for i, chunk in enumerate(chunks):
+        data = {"chat_id": chat_id, "text": chunk}
+        encoded_data = json.dumps(data).encode('utf-8')
+        response = telegram_request('sendMessage', body=encoded_data, headers={'Content-Type': 'application/json'})
+        if i == 0:
+            try:
+                message_id = json.loads(response.data)['result']['message_id']
+            except (ValueError, KeyError, TypeError):
+                pass
+    return message_id
+
+
+def edit_message(chat_id, message_id, message):
+    data = {"chat_id": chat_id, "message_id": message_id, "text": message}
     encoded_data = json.dumps(data).encode('utf-8')
-    HTTP.request('POST', url, body=encoded_data, headers={'Content-Type': 'application/json'})
+    telegram_request('editMessageText', body=encoded_data, headers={'Content-Type': 'application/json'})
 
 
-def save_message_to_dynamodb(chat_id, message_text, first_name=None, last_name=None):
+def parse_progress_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None  # yt-dlp prints NA for unknown values
+
+
+class DownloadProgress:
+    """
+    Parse yt-dlp output lines as they arrive, keep per-stage durations and bytes, and forward
+    each download progress update (percent, speed, ETA) to a callback
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stages = {}
+        self.current_stage = None
+
+    def start_stage(self, name):
+        now = time.time()
+        if self.current_stage:
+            self.stages[self.current_stage]["end"] = now
+        self.current_stage = name
+        self.stages.setdefault(name, {"start": now, "end": now, "bytes": 0})
+
+    def update_download(self, format_id, downloaded, total, speed, eta):
+        stage = f"download {format_id}"
+        if stage != self.current_stage:
+            self.start_stage(stage)
+        self.stages[stage]["bytes"] = downloaded or 0
+        update = {
+            "stage": stage,
+            "downloaded": downloaded,
+            "total": total,
+            "percent": downloaded / total * 100 if downloaded is not None and total else None,
+            "speed": speed,
+            "eta": eta}
+        if self.callback:
+            self.callback(update)
+
+    def update_postprocessing(self, name):
+        if name in POSTPROCESSING_STAGES and name != self.current_stage:
+            self.start_stage(name)
+
+    def feed_line(self, line):
+        """
+        Parse a line of the yt-dlp subprocess output
+        """
+        line = line.strip()
+        if line.startswith(PROGRESS_PREFIX):
+            fields = line[len(PROGRESS_PREFIX):].split()
+            if len(fields) != 6:
+                return
+            downloaded, total, total_estimate, speed, eta = (parse_progress_number(v) for v in fields[1:])
+            self.update_download(fields[0], downloaded, total or total_estimate, speed, eta)
+        else:
+            match = re.match(r"\[(\w+)\]", line)
+            if match:
+                self.update_postprocessing(match.group(1))
+
+    def progress_hook(self, status):
+        """
+        yt-dlp progress hook of the in-process engine
+        """
+        if status.get("status") == "downloading":
+            self.update_download(status.get("info_dict", {}).get("format_id"), status.get("downloaded_bytes"),
+                                 status.get("total_bytes") or status.get("total_bytes_estimate"),
+                                 status.get("speed"), status.get("eta"))
+
+    def postprocessor_hook(self, status):
+        """
+        yt-dlp postprocessor hook of the in-process engine
+        """
+        if status.get("status") == "started":
+            self.update_postprocessing(status.get("postprocessor"))
+
+    def finish(self):
+        if self.current_stage:
+            self.stages[self.current_stage]["end"] = time.time()
+            self.current_stage = None
+
+    def summary(self):
+        """
+        Return the duration, bytes and throughput of each stage
+        """
+        summary = []
+        for name, stage in self.stages.items():
+            seconds = stage["end"] - stage["start"]
+            summary.append({
+                "stage": name,
+                "seconds": round(seconds, 3),
+                "bytes": int(stage["bytes"]),
+                "bytes_per_second": int(stage["bytes"] / seconds) if seconds > 0 else None})
+        return summary
+
+
+def make_progress_notifier(chat_id, message_id):
+    """
+    Return a progress callback editing the given message in place, at most every PROGRESS_EDIT_INTERVAL_SECONDS
+    """
+    state = {"last_edit": 0, "last_text": None}
+
+    def notify(update):
+        now = time.time()
+        if message_id is None or now - state["last_edit"] < PROGRESS_EDIT_INTERVAL_SECONDS:
+            return
+        text = "Download in progress"
+        if update["percent"] is not None:
+            text += f": {update['percent']:.0f}% of {update['total'] / (1024 * 1024):.1f} MB"
+        if update["speed"]:
+            text += f" at {update['speed'] / (1024 * 1024):.1f} MB/s"
+        if update["eta"] is not None:
+            text += f", {int(update['eta'])} s left"
+        text += " 🔄"
+        if text == state["last_text"]:
+            return
+        state["last_edit"] = now
+        state["last_text"] = text
+        edit_message(chat_id, message_id, text)
+
+    return notify
+
+
+def emit_metrics(metrics, dimensions=None, properties=None):
+    """
+    Write metrics as a CloudWatch Embedded Metric Format line: CloudWatch extracts them from the logs,
+    without any API call. metrics: {name: (value, unit)}, dimensions: {name: value}
     """
-    Save the user's message to DynamoDB.
+    dimensions = dimensions or {}
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [list(dimensions)],
+                "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in metrics.items()]}]},
+        **(properties or {}),
+        **{name: str(value) for name, value in dimensions.items()},
+        **{name: value for name, (value, _) in metrics.items()}}
+    # Printed rather than logged, the Lambda log format would prefix the JSON
+    print(json.dumps(record), flush=True)
+
+
+class JobMetrics:
     """
+    Collect the duration and bytes of each stage of a job, then emit them as EMF metrics
+    (StageDuration and StageBytes by Job, Stage and the job dimensions, JobDuration by Job and dimensions).
+    Outside Lambda, a per-stage breakdown is printed as well (stages can be nested, e.g. cookies in preflight)
+    """
+
+    def __init__(self, job, **dimensions):
+        self.job = job
+        self.dimensions = dimensions
+        self.stages = {}
+        self.start = time.time()
+
+    def add_stage(self, name, seconds, size=None):
+        stage = self.stages.setdefault(name, {"seconds": 0, "bytes": 0})
+        stage["seconds"] += seconds
+        stage["bytes"] += size or 0
+
+    def emit(self):
+        total = time.time() - self.start
+        for name, stage in self.stages.items():
+            metrics = {"StageDuration": (round(stage["seconds"] * 1000, 1), "Milliseconds")}
+            if stage["bytes"]:
+                metrics["StageBytes"] = (int(stage["bytes"]), "Bytes")
+            emit_metrics(metrics, {"Job": self.job, "Stage": name, **self.dimensions})
+        emit_metrics({"JobDuration": (round(total * 1000, 1), "Milliseconds")}, {"Job": self.job, **self.dimensions})
+
+        if LOCAL_METRICS:
+            lines = [f"{self.job} job ({', '.join(f'{k}={v}' for k, v in self.dimensions.items())}): {total:.3f} s"]
+            for name, stage in self.stages.items():
+                line = f"  {name:<24} {stage['seconds']:8.3f} s {stage['seconds'] / total * 100 if total else 0:5.1f}%"
+                if stage["bytes"]:
+                    line += f"  {stage['bytes'] / (1024 * 1024):8.2f} MB"
+                lines.append(line)
+            print("\n".join(lines))
+
+
+def record_stage(name, seconds, size=None):
+    """
+    Add a stage to the download job being processed, if any
+    """
+    job = JOB_METRICS["current"]
+    if job is not None:
+        job.add_stage(name, seconds, size)
+
+
+def set_job_dimension(name, value):
+    job = JOB_METRICS["current"]
+    if job is not None:
+        job.dimensions[name] = value
+
+
+@contextmanager
+def timed_stage(name):
+    """
+    Time the block as a stage of the current download job. The block can set stage["bytes"]
+    """
+    stage = {"bytes": None}
+    start = time.time()
     try:
-        item = {
-            'chat_id': str(chat_id),  # Using only chat_id as the key
-            'timestamp': datetime.utcnow().isoformat(),
-            'message': message_text,
-            'first_name': first_name,
-            'last_name': last_name
-        }
-        MESSAGES_TABLE.put_item(Item=item)
-        logger.info(f"Message saved to DynamoDB for chat_id: {chat_id}")
-    except Exception as e:
-        logger.error(f"Error saving message to DynamoDB: {e}")
+        yield stage
+    finally:
+        record_stage(name, time.time() - start, stage["bytes"])
 
 
-def get_message_history(chat_id, limit=25):
+def save_message_to_dynamodb(chat_id, message_text, first_name=None, last_name=None):
+    """
+    Buffer the user's message for DynamoDB. The buffer is written when it is full, before a message is
+    processed and at the end of the invocation (see flush_message_history)
+    """
+    item = {
+        'chat_id': str(chat_id),  # Using only chat_id as the key
+        'timestamp': datetime.utcnow().isoformat(),
+        'message': message_text,
+        'first_name': first_name,
+        'last_name': last_name
+    }
+    if HISTORY_TTL_DAYS:
+        item['expires_at'] = int(time.time()) + HISTORY_TTL_DAYS * 86400
+    HISTORY_BUFFER.append(item)
+    logger.info(f"Message buffered for DynamoDB for chat_id: {chat_id}")
+
+    if len(HISTORY_BUFFER) >= HISTORY_BUFFER_SIZE:
+        flush_message_history()
+
+
+def flush_message_history():
     """
-    Retrieve the user's message history from DynamoDB, sorted by timestamp.
+    Write the buffered messages with BatchWriteItem, retrying unprocessed items with exponential backoff
+    """
+    if not HISTORY_BUFFER:
+        return
+
+    # A batch can't contain the same key twice, the last write wins like with batch_writer(overwrite_by_pkeys)
+    items = {(item['chat_id'], item['timestamp']): item for item in HISTORY_BUFFER}
+    HISTORY_BUFFER.clear()
+    requests = [{'PutRequest': {'Item': item}} for item in items.values()]
+    client = DYNAMODB.meta.client
+
+    for i in range(0, len(requests), HISTORY_BUFFER_SIZE):
+        batch = requests[i:i + HISTORY_BUFFER_SIZE]
+        try:
+            for attempt in range(HISTORY_WRITE_MAX_ATTEMPTS):
+                response = client.batch_write_item(RequestItems={MESSAGES_TABLE.name: batch})
+                batch = response.get('UnprocessedItems', {}).get(MESSAGES_TABLE.name, [])
+                if not batch:
+                    break
+                time.sleep(0.05 * 2 ** attempt)
+        except ClientError as e:
+            logger.error(f"Error saving messages to DynamoDB: {e}")
+        if batch:
+            logger.error(f"{len(batch)} message(s) could not be saved to DynamoDB")
+
+    logger.info(f"{len(requests)} message(s) saved to DynamoDB")
+
+
+def get_message_history(chat_id, limit=25, cursor=None):
+    """
+    Retrieve a page of the user's message history from DynamoDB, most recent first.
+    Return the messages and the cursor of the next page (None on the last page)
     """
     try:
-        response = MESSAGES_TABLE.query(
-            KeyConditionExpression='chat_id = :chat_id',
-            ExpressionAttributeValues={':chat_id': str(chat_id)},
-            Limit=limit,
-            ScanIndexForward=True  # Get most recent as last
-        )
-        return response['Items']
+        query_kwargs = {
+            'KeyConditionExpression': 'chat_id = :chat_id',
+            'ExpressionAttributeValues': {':chat_id': str(chat_id)},
+            'ProjectionExpression': '#ts, message',
+            'ExpressionAttributeNames': {'#ts': 'timestamp'},
+            'Limit': limit,
+            'ScanIndexForward': False}  # Get most recent first
+        if cursor:
+            query_kwargs['ExclusiveStartKey'] = cursor
+        response = MESSAGES_TABLE.query(**query_kwargs)
+        return response['Items'], response.get('LastEvaluatedKey')
     except Exception as e:
         logger.error(f"Error retrieving message history from DynamoDB: {e}")
-        return None
+        return None, None
 
 
-def zip_file(file_path, target_dir=None):
+def zip_file(file_path, target_dir=None, compression=zipfile.ZIP_DEFLATED):
     """
     Create a zip file from the downloaded video
     """
@@ -135,7 +686,7 @@ def zip_file(file_path, target_dir=None):
     zip_file_path = os.path.join(zip_dir, f"{os.path.splitext(file_name)[0]}.zip")
 
     try:
-        with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        with zipfile.ZipFile(zip_file_path, 'w', compression) as zipf:
             zipf.write(file_path, arcname=file_name)
         logger.info(f"Successfully zipped file: {zip_file_path}")
         return zip_file_path
@@ -144,9 +695,48 @@ def zip_file(file_path, target_dir=None):
         return None
 
 
-def get_s3_key(chat_id, file_name, first_name=None, last_name=None):
+def is_compressible(file_path):
     """
-    Generate the S3 key using chat_id, first_name, and last_name as folder structure
+    Estimate whether deflate is worth its CPU time by compressing a few samples spread across the file
+    """
+    file_size = os.path.getsize(file_path)
+    step = max(file_size // COMPRESSIBILITY_SAMPLES, COMPRESSIBILITY_SAMPLE_SIZE)
+    raw_size = compressed_size = 0
+    with open(file_path, 'rb') as f:
+        for offset in range(0, file_size, step):
+            f.seek(offset)
+            sample = f.read(COMPRESSIBILITY_SAMPLE_SIZE)
+            raw_size += len(sample)
+            compressed_size += len(zlib.compress(sample, 1))
+
+    ratio = compressed_size / raw_size if raw_size else 1
+    logger.info(f"Compressibility sample ratio of {os.path.basename(file_path)}: {ratio:.3f}")
+    return ratio < COMPRESSIBILITY_THRESHOLD
+
+
+def package_for_s3(file_path):
+    """
+    Prepare the downloaded file for S3 according to S3_PACKAGING.
+    Return the path to upload, the S3 ExtraArgs and a note for the user message
+    """
+    if S3_PACKAGING != "raw":
+        compressible = S3_PACKAGING == "auto" and is_compressible(file_path)
+        compression = zipfile.ZIP_DEFLATED if compressible else zipfile.ZIP_STORED
+        zip_file_path = zip_file(file_path, compression=compression)
+        if zip_file_path:
+            return zip_file_path, {"ContentType": MEDIA_CONTENT_TYPES[".zip"]}, " (as a zip file)"
+        logger.error("Zipping failed, uploading the raw file instead")
+
+    file_name = os.path.basename(file_path)
+    extra_args = {
+        "ContentType": MEDIA_CONTENT_TYPES.get(os.path.splitext(file_name)[1], "application/octet-stream"),
+        "ContentDisposition": get_content_disposition(file_name)}
+    return file_path, extra_args, ""
+
+
+def get_s3_folder(chat_id, first_name=None, last_name=None):
+    """
+    Generate the user's folder name using chat_id, first_name, and last_name
     """
     # Create a folder name with available user info
     folder_parts = [str(chat_id)]
@@ -155,19 +745,105 @@ def get_s3_key(chat_id, file_name, first_name=None, last_name=None):
     if last_name:
         folder_parts.append(last_name)
 
-    folder_name = "_".join(folder_parts)
-    return f"{folder_name}/{file_name}"
+    return "_".join(folder_parts)
+
+
+def get_s3_key(chat_id, file_name, first_name=None, last_name=None):
+    """
+    Generate the S3 key using chat_id, first_name, and last_name as folder structure
+    """
+    return f"{get_s3_folder(chat_id, first_name, last_name)}/{file_name}"
+
+
+def rebuild_s3_manifest(folder):
+    """
+    Rebuild the manifest of a user's folder from a full (paginated) listing of S3, and return its files.
+    Entries written by uploads that finish during the rebuild are newer than the listing and are kept
+    """
+    s3 = get_aws_client('s3')
+    listed_at = int(time.time())
+    files = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=S3_YT_VIDEOS_BUCKET_NAME, Prefix=f"{folder}/"):
+        for obj in page.get('Contents', []):
+            files[obj['Key'].split('/', 1)[1]] = {
+                'size': obj['Size'],
+                'last_modified': int(obj['LastModified'].timestamp())}
+
+    with FILES_TABLE.batch_writer(overwrite_by_pkeys=['folder', 'file_name']) as batch:
+        for file_name, entry in files.items():
+            batch.put_item(Item={'folder': folder, 'file_name': file_name, **entry})
+
+    # Entries of files no longer in S3, unless they were added after the listing started
+    for file_name in set(get_s3_manifest(folder)) - set(files):
+        try:
+            FILES_TABLE.delete_item(
+                Key={'folder': folder, 'file_name': file_name},
+                ConditionExpression="last_modified < :listed_at",
+                ExpressionAttributeValues={':listed_at': listed_at})
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+    STATE_TABLE.put_item(Item={'pk': f"manifest#{folder}", 'rebuilt_at': listed_at})
+    logger.info(f"Rebuilt the manifest of {folder}: {len(files)} file(s)")
+    return get_s3_manifest(folder)
+
+
+def get_s3_manifest(folder):
+    """
+    Return the files of a user's folder manifest (one item per file, read with a paginated Query)
+    """
+    files = {}
+    query_kwargs = {
+        'KeyConditionExpression': 'folder = :folder',
+        'ExpressionAttributeValues': {':folder': folder}}
+    while True:
+        response = FILES_TABLE.query(**query_kwargs)
+        for item in response['Items']:
+            files[item['file_name']] = {'size': item['size'], 'last_modified': item['last_modified']}
+        if 'LastEvaluatedKey' not in response:
+            return files
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def add_to_s3_manifest(s3_key, size):
+    """
+    Record an uploaded file in the manifest of its user's folder
+    """
+    folder, file_name = s3_key.split('/', 1)
+    try:
+        FILES_TABLE.put_item(Item={
+            'folder': folder,
+            'file_name': file_name,
+            'size': size,
+            'last_modified': int(time.time())})
+    except ClientError as e:
+        logger.error(f"Error updating the manifest of {folder}: {e}")
+
+
+def remove_from_s3_manifest(*s3_keys):
+    """
+    Remove deleted files from the manifests of their user's folder
+    """
+    try:
+        with FILES_TABLE.batch_writer() as batch:
+            for s3_key in s3_keys:
+                folder, file_name = s3_key.split('/', 1)
+                batch.delete_item(Key={'folder': folder, 'file_name': file_name})
+    except ClientError as e:
+        logger.error(f"Error updating the manifest of {', '.join(s3_keys)}: {e}")
 
 
-def upload_file_to_s3(file_path, chat_id, first_name=None, last_name=None):
-    s3 = boto3.client('s3')
+def upload_file_to_s3(file_path, chat_id, first_name=None, last_name=None, extra_args=None):
+    s3 = get_aws_client('s3')
 
     file_name = os.path.basename(file_path)
     s3_key = get_s3_key(chat_id, file_name, first_name, last_name)
 
     try:
-        s3.upload_file(file_path, S3_YT_VIDEOS_BUCKET_NAME, s3_key)
+        s3.upload_file(file_path, S3_YT_VIDEOS_BUCKET_NAME, s3_key, ExtraArgs=extra_args)
         logger.info(f"Successfully uploaded to S3: {s3_key}")
+        add_to_s3_manifest(s3_key, os.path.getsize(file_path))
     except ClientError as e:
         logger.error(f"Error uploading file to S3: {e}")
         return None
@@ -175,8 +851,101 @@ def upload_file_to_s3(file_path, chat_id, first_name=None, last_name=None):
     return s3_key
 
 
+def get_content_disposition(file_name):
+    """
+    Build a Content-Disposition header so that a raw media object plays in the browser (S3_MEDIA_DISPOSITION "inline")
+    or downloads ("attachment"), under its original name in both cases
+    """
+    ascii_name = file_name.encode('ascii', 'ignore').decode().replace('"', '') or "download"
+    return f"""{S3_MEDIA_DISPOSITION}; filename="{ascii_name}"; filename*=UTF-8''{quote(file_name)}"""
+
+
+class S3MultipartWriter:
+    """
+    Write-only file object that uploads to S3 as a multipart upload while data is still being written.
+    Parts are sent in parallel and at most S3_MULTIPART_MAX_INFLIGHT of them are held in memory
+    """
+
+    def __init__(self, bucket, key, **create_kwargs):
+        self.s3 = get_aws_client('s3')
+        self.bucket = bucket
+        self.key = key
+        self.upload_id = self.s3.create_multipart_upload(Bucket=bucket, Key=key, **create_kwargs)['UploadId']
+        self.executor = ThreadPoolExecutor(max_workers=S3_MULTIPART_MAX_INFLIGHT)
+        self.slots = threading.BoundedSemaphore(S3_MULTIPART_MAX_INFLIGHT)
+        self.buffer = bytearray()
+        self.futures = []
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.bytes_written += len(data)
+        while len(self.buffer) >= S3_MULTIPART_PART_SIZE:
+            self._submit_part(bytes(self.buffer[:S3_MULTIPART_PART_SIZE]))
+            del self.buffer[:S3_MULTIPART_PART_SIZE]
+        return len(data)
+
+    def tell(self):
+        return self.bytes_written
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def _submit_part(self, data):
+        self.slots.acquire()  # Blocks the writer while too many parts are in flight
+        part_number = len(self.futures) + 1
+        self.futures.append(self.executor.submit(self._upload_part, part_number, data))
+
+    def _upload_part(self, part_number, data):
+        try:
+            response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=part_number, Body=data)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self.slots.release()
+
+    def close(self):
+        """
+        Upload the remaining buffer and complete the multipart upload
+        """
+        if self.buffer or not self.futures:
+            self._submit_part(bytes(self.buffer))
+            self.buffer.clear()
+        try:
+            parts = [future.result() for future in self.futures]
+        finally:
+            self.executor.shutdown(wait=True)
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                          MultipartUpload={'Parts': parts})
+        logger.info(f"Completed multipart upload of {self.bytes_written} bytes in {len(parts)} parts: {self.key}")
+
+    def abort(self):
+        self.executor.shutdown(wait=True)
+        try:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except ClientError as e:
+            logger.error(f"Error aborting multipart upload {self.key}: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
+        try:
+            self.close()
+        except Exception:
+            # A failed part or completion would otherwise leave the upload (and its billed parts) behind
+            self.abort()
+            raise
+
+
 def generate_url(s3_key):
-    s3 = boto3.client('s3', config=Config(signature_version='s3v4'))
+    s3 = get_aws_client('s3', signature_version='s3v4')
     try:
         url = s3.generate_presigned_url('get_object',
                                         Params={'Bucket': S3_YT_VIDEOS_BUCKET_NAME, 'Key': s3_key},
@@ -187,230 +956,1485 @@ def generate_url(s3_key):
         return None
 
 
-def send_video_or_link(chat_id, file_path, first_name=None, last_name=None):
-    file_name = os.path.basename(file_path)
-    file_size_mb = os.path.getsize(file_path) / (1024 * 1024)  # Convert to MB
-    logger.info(f"File size: {file_size_mb:.2f} MB")
+def send_download_link(chat_id, s3_key, file_name, file_size_mb, media, note=""):
+    """
+    Send a presigned link to an object of the videos bucket
+    """
+    file_url = generate_url(s3_key)
+    if file_url:
+        msg = f"Here's your {media}{note} 🍿\n\n{file_name}\n{file_size_mb:.2f} MB\n\n{file_url}"
+        send_message(chat_id, msg)
+        logger.info(f"{media} uploaded to S3 and link sent to user")
+        return True
+
+    logger.error("Failed to generate pre-signed URL")
+    send_message(chat_id, "Sorry, there was an error creating the download URL 🥲")
+    return False
+
+
+def get_telegram_file_id_key(video_id, resolution):
+    """
+    Return the key of the file_id index entry of a media, None if it can't be derived. Like the download cache,
+    it depends on the post-processing arguments and the yt-dlp version, so that changing them stops the reuse
+    """
+    cache_id = get_download_cache_id(video_id, resolution)
+    return f"file_id#{cache_id}" if cache_id else None
+
+
+def save_telegram_file_id(video_id, resolution, response):
+    """
+    Index the file_id Telegram returned for an uploaded media, so that the next request can resend it
+    """
+    try:
+        file_id_key = get_telegram_file_id_key(video_id, resolution)
+        if file_id_key is None:
+            return
+        result = json.loads(response.data).get('result', {})
+        for media_type in TELEGRAM_SEND_METHODS:
+            if media_type in result:
+                STATE_TABLE.put_item(Item={
+                    'pk': file_id_key,
+                    'media_type': media_type,
+                    'file_id': result[media_type]['file_id']})
+                logger.info(f"Saved Telegram file_id for {video_id} ({resolution})")
+                return
+    except (ValueError, ClientError) as e:
+        logger.error(f"Error saving Telegram file_id: {e}")
+
+
+def send_by_telegram_file_id(chat_id, video_id, resolution):
+    """
+    Resend a media previously uploaded to Telegram using its file_id. Return False if there is none
+    or if Telegram refuses it (the stale entry is then removed)
+    """
+    try:
+        file_id_key = get_telegram_file_id_key(video_id, resolution)
+        if file_id_key is None:
+            return False
+        item = STATE_TABLE.get_item(Key={'pk': file_id_key}).get('Item')
+        if item is None:
+            return False
+
+        data = {"chat_id": chat_id, item['media_type']: item['file_id']}
+        response = telegram_request(TELEGRAM_SEND_METHODS[item['media_type']],
+                                    body=json.dumps(data).encode('utf-8'),
+                                    headers={'Content-Type': 'application/json'})
+        if response.status == 200:
+            logger.info(f"Sent {video_id} ({resolution}) by Telegram file_id")
+            return True
+
+        logger.warning(f"Telegram refused the file_id of {video_id} ({resolution}): {response.data}")
+        STATE_TABLE.delete_item(Key={'pk': file_id_key})
+        return False
+    except ClientError as e:
+        logger.error(f"Error reading Telegram file_id: {e}")
+        return False
+
+
+def get_media_info(file_path):
+    """
+    Read the duration (seconds) and the video width and height of a media file from the header printed by
+    ffmpeg (the layer has no ffprobe). Missing values are None
+    """
+    try:
+        process = subprocess.run([FFMPEG_PATH, "-hide_banner", "-i", file_path], capture_output=True, text=True)
+    except OSError as e:
+        logger.error(f"Unable to run ffmpeg to read the media info of {file_path}: {e}")
+        return {"duration": None, "width": None, "height": None}
+    duration = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", process.stderr)
+    size = re.search(r"Stream #.*Video: .*?, (\d{2,5})x(\d{2,5})", process.stderr)
+    if not duration:
+        logger.error(f"Unable to read the media info of {file_path}: {process.stderr[-500:]}")
+    return {
+        "duration": int(duration.group(1)) * 3600 + int(duration.group(2)) * 60 + float(duration.group(3))
+        if duration else None,
+        "width": int(size.group(1)) if size else None,
+        "height": int(size.group(2)) if size else None}
+
+
+def is_faststart(file_path):
+    """
+    Tell if the index (moov box) of an MP4 file comes before its media data (mdat box)
+    """
+    with open(file_path, 'rb') as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            box_size, box_type = int.from_bytes(header[:4], 'big'), header[4:]
+            if box_type == b'moov':
+                return True
+            if box_type == b'mdat' or box_size == 0:
+                return False
+            if box_size == 1:  # 64-bit size
+                box_size = int.from_bytes(f.read(8), 'big') - 8
+            f.seek(box_size - 8, 1)
+
+
+def ensure_faststart(file_path):
+    """
+    Remux an MP4 file with its index first when yt-dlp's merger didn't already do it (single format, clip)
+    """
+    if not file_path.endswith('.mp4') or is_faststart(file_path):
+        return
+    remuxed_path = f"{file_path}.faststart.mp4"
+    command = [FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-i", file_path, "-map", "0", "-c", "copy",
+               *FASTSTART_ARGS.split(), remuxed_path]
+    logger.info(f"Executing command: {' '.join(command)}")
+    try:
+        process = subprocess.run(command, capture_output=True, text=True)
+    except OSError as e:
+        logger.error(f"Unable to run ffmpeg to remux {file_path} for faststart: {e}")
+        return
+    if process.returncode != 0:
+        logger.error(f"ffmpeg failed to remux {file_path} for faststart: {process.stderr}")
+        if os.path.exists(remuxed_path):
+            os.remove(remuxed_path)
+        return
+    os.replace(remuxed_path, file_path)
+
+
+def fetch_thumbnail(video_id, directory):
+    """
+    Download the YouTube thumbnail of a video for sendVideo/sendAudio, return its path or None
+    """
+    try:
+        response = HTTP.request('GET', THUMBNAIL_URL.format(video_id=video_id.split('#')[0]),
+                                timeout=5.0, retries=False)
+        if response.status != 200:
+            logger.warning(f"No thumbnail for {video_id}: HTTP {response.status}")
+            return None
+        thumbnail_path = os.path.join(directory, "thumbnail.jpg")
+        with open(thumbnail_path, 'wb') as f:
+            f.write(response.data)
+        return thumbnail_path
+    except urllib3.exceptions.HTTPError as e:
+        logger.warning(f"Unable to download the thumbnail of {video_id}: {e}")
+        return None
+
+
+def split_media(file_path):
+    """
+    Cut a media file at keyframes into parts under TELEGRAM_MAX_UPLOAD_MB, without re-encoding.
+    Return the paths of the parts in order, or None if it couldn't be split
+    """
+    duration = get_media_info(file_path)["duration"]
+    if not duration:
+        return None
+    max_size = TELEGRAM_MAX_UPLOAD_MB * 1024 * 1024
+    target_size = SPLIT_TARGET_MB * 1024 * 1024
+    segment_seconds = duration * target_size / os.path.getsize(file_path)
+    extension = os.path.splitext(file_path)[1]
+
+    for attempt in range(SPLIT_MAX_ATTEMPTS):
+        parts_dir = tempfile.mkdtemp(prefix="parts_", dir=os.path.dirname(file_path))
+        command = [
+            FFMPEG_PATH, "-hide_banner", "-loglevel", "error",
+            "-i", file_path,
+            "-map", "0",
+            "-c", "copy",
+            "-f", "segment",
+            "-segment_time", f"{segment_seconds:.3f}",
+            "-reset_timestamps", "1"]
+        if extension in (".mp4", ".m4a"):
+            # Only the MP4 muxer knows movflags, the segment muxer rejects unknown options (mp3, ogg)
+            command.extend(["-segment_format_options", "movflags=+faststart"])
+        command.append(os.path.join(parts_dir, f"part%03d{extension}"))
+        logger.info(f"Executing command: {' '.join(command)}")
+        process = subprocess.run(command, capture_output=True, text=True)
+        if process.returncode != 0:
+            logger.error(f"ffmpeg failed to split {file_path}: {process.stderr}")
+            shutil.rmtree(parts_dir, ignore_errors=True)
+            return None
+
+        parts = [os.path.join(parts_dir, name) for name in sorted(os.listdir(parts_dir))]
+        largest_size = max(os.path.getsize(part) for part in parts)
+        if largest_size < max_size:
+            logger.info(f"Split {file_path} into {len(parts)} parts of {segment_seconds:.0f} s")
+            return parts
+
+        # Keyframes are too far apart for this segment length, retry with shorter parts
+        logger.info(f"Part of {largest_size} bytes over the limit (attempt {attempt + 1}), splitting again")
+        segment_seconds *= target_size / largest_size
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    return None
+
+
+def group_media_parts(parts):
+    """
+    Group the parts for sendMediaGroup in as few groups as possible, with balanced sizes so that
+    no group is left with a single item
+    """
+    group_count = -(-len(parts) // MEDIA_GROUP_MAX_ITEMS)
+    group_size, extra = divmod(len(parts), group_count)
+    groups, start = [], 0
+    for index in range(group_count):
+        end = start + group_size + (1 if index < extra else 0)
+        groups.append(parts[start:end])
+        start = end
+    return groups
+
+
+def send_media_parts(chat_id, file_path):
+    """
+    Deliver a file too big for Telegram as parts under the limit, sent as media groups uploaded in parallel.
+    Return True if all the parts were sent
+    """
+    start_time = time.time()
+    with timed_stage("split"):
+        parts = split_media(file_path)
+    if not parts:
+        return False
+
+    try:
+        file_name, extension = os.path.splitext(os.path.basename(file_path))
+        media_type = TELEGRAM_MEDIA_TYPES.get(extension, "document")
+        content_type = MEDIA_CONTENT_TYPES.get(extension, "application/octet-stream")
+        numbered = list(enumerate(parts, start=1))
+
+        def send_group(group):
+            if len(group) == 1:
+                index, part = group[0]
+                fields = {"chat_id": str(chat_id), "caption": f"{file_name} ({index}/{len(parts)})"}
+                if media_type == "video":
+                    fields["supports_streaming"] = "true"
+                files = {media_type: (f"{file_name} ({index}-{len(parts)}){extension}", part, content_type)}
+                api_method = TELEGRAM_SEND_METHODS[media_type]
+            else:
+                media = [{"type": media_type, "media": f"attach://part{index}",
+                          "caption": f"{file_name} ({index}/{len(parts)})"} for index, _ in group]
+                if media_type == "video":
+                    for item in media:
+                        item["supports_streaming"] = True
+                fields = {"chat_id": str(chat_id), "media": json.dumps(media)}
+                files = {f"part{index}": (f"{file_name} ({index}-{len(parts)}){extension}", part, content_type)
+                         for index, part in group}
+                api_method = "sendMediaGroup"
+            body_factory, headers = build_multipart_body(fields, files)
+            response = telegram_request(api_method, body_factory=body_factory, headers=headers)
+            if response.status != 200:
+                logger.error(f"Failed to send parts {[index for index, _ in group]}: {response.data}")
+            return response.status == 200
+
+        groups = group_media_parts(numbered)
+        with timed_stage("telegram_upload") as stage:
+            with ThreadPoolExecutor(max_workers=min(len(groups), SPLIT_UPLOAD_CONCURRENCY)) as executor:
+                sent = all(list(executor.map(send_group, groups)))
+            stage["bytes"] = sum(os.path.getsize(part) for part in parts)
+        logger.info(f"Sent {len(parts)} parts in {len(groups)} groups in {time.time() - start_time:.2f} s")
+        return sent
+    finally:
+        shutil.rmtree(os.path.dirname(parts[0]), ignore_errors=True)
+
+
+def send_video_or_link(chat_id, file_path, first_name=None, last_name=None, video_id=None, resolution=None,
+                       cache=False):
+    """
+    Deliver a downloaded file in Telegram, in parts or as an S3 link, then delete it.
+    cache stores it in the download cache once delivered (for a raw S3 link, the upload to the cache
+    comes first and the user's copy is made from it server-side)
+    """
+    cached = False
+    file_name = os.path.basename(file_path)
+    file_size_mb = os.path.getsize(file_path) / (1024 * 1024)  # Convert to MB
+    logger.info(f"File size: {file_size_mb:.2f} MB")
+
+    # If the file size is less than 50MB, send it directly
+    if file_size_mb < TELEGRAM_MAX_UPLOAD_MB:
+        logger.info(f"File is {file_size_mb:.2f}MB, sending directly")
+        content_type = MEDIA_CONTENT_TYPES.get(os.path.splitext(file_name)[1], "application/octet-stream")
+        with timed_stage("media_info"):
+            media_info = get_media_info(file_path)
+        fields = {"chat_id": str(chat_id)}
+        if media_info["duration"]:
+            fields["duration"] = str(round(media_info["duration"]))
+        media_type = TELEGRAM_MEDIA_TYPES.get(os.path.splitext(file_name)[1], "document")
+        api_method = TELEGRAM_SEND_METHODS[media_type]
+        files = {media_type: (file_name, file_path, content_type)}
+        if media_type == "video":
+            fields["supports_streaming"] = "true"
+            if media_info["width"] and media_info["height"]:
+                fields["width"], fields["height"] = str(media_info["width"]), str(media_info["height"])
+        with timed_stage("thumbnail"):
+            thumbnail_path = fetch_thumbnail(video_id, os.path.dirname(file_path)) if video_id else None
+        if thumbnail_path:
+            fields["thumbnail"] = "attach://thumbnail"
+            files["thumbnail"] = ("thumbnail.jpg", thumbnail_path, "image/jpeg")
+
+        body_factory, headers = build_multipart_body(fields, files)
+        with timed_stage("telegram_upload") as stage:
+            response = telegram_request(api_method, body_factory=body_factory, headers=headers)
+            stage["bytes"] = os.path.getsize(file_path)
+        set_job_dimension("Delivery", "telegram")
+        logger.info(f"Response of the POST request: {response.data}")
+        if video_id and TELEGRAM_FILE_ID_REUSE and response.status == 200:
+            save_telegram_file_id(video_id, resolution, response)
+        if thumbnail_path:
+            os.remove(thumbnail_path)
+
+    # If the file size is TELEGRAM_MAX_UPLOAD_MB or more, send it in parts when the split delivery is enabled
+    elif LARGE_FILE_DELIVERY == "split" and send_media_parts(chat_id, file_path):
+        logger.info(f"File is {file_size_mb:.2f}MB, sent in parts")
+        set_job_dimension("Delivery", "split")
+
+    # Otherwise (or if it couldn't be split) package it, upload to S3 and send the link
+    else:
+        logger.info(f"File is {file_size_mb:.2f}MB, packaging ({S3_PACKAGING}), uploading to S3 and sending link")
+
+        media = "audio/music" if os.path.splitext(file_name)[1] in AUDIO_EXTENSIONS.values() else "video"
+
+        with timed_stage("package"):
+            upload_path, extra_args, note = package_for_s3(file_path)
+        s3_key = None
+        if cache and upload_path == file_path:
+            # The same bytes go to the cache and to the user's folder, upload them once
+            cached = True
+            with timed_stage("cache_store") as stage:
+                cache_s3_key = store_in_download_cache(video_id, resolution, file_path)
+                stage["bytes"] = os.path.getsize(file_path)
+            if cache_s3_key:
+                with timed_stage("s3_copy"):
+                    try:
+                        s3_key = copy_from_download_cache(cache_s3_key, file_name, os.path.getsize(file_path),
+                                                          chat_id, first_name, last_name)
+                    except ClientError as e:
+                        logger.error(f"Error copying from the download cache: {e}")
+        if s3_key is None:
+            with timed_stage("s3_upload") as stage:
+                s3_key = upload_file_to_s3(upload_path, chat_id, first_name, last_name, extra_args=extra_args)
+                stage["bytes"] = os.path.getsize(upload_path)
+        if upload_path != file_path:
+            os.remove(upload_path)
+        if s3_key:
+            with timed_stage("telegram_message"):
+                send_download_link(chat_id, s3_key, file_name, file_size_mb, media, note=note)
+            set_job_dimension("Delivery", "link")
+        else:
+            logger.error(f"Failed to upload {media} to S3")
+            send_message(chat_id, f"Sorry, there was an error sending the {media} to the server 🥲")
+
+    # Cached after the delivery, so the first request doesn't wait for this upload
+    if cache and not cached:
+        with timed_stage("cache_store") as stage:
+            store_in_download_cache(video_id, resolution, file_path)
+            stage["bytes"] = os.path.getsize(file_path)
+    os.remove(file_path)
+
+
+def get_cookie_file(cookie_file):
+    """
+    Copy the YouTube cookies to cookie_file. The cookies are downloaded once per container, then
+    revalidated with their ETag every COOKIE_CACHE_TTL_SECONDS. Each job gets its own copy because
+    yt-dlp rewrites the cookies file
+    """
+    start = time.time()
+    with COOKIE_CACHE_LOCK:
+        cached = COOKIE_CACHE["etag"] is not None and os.path.exists(COOKIE_CACHE_PATH)
+        if cached and start - COOKIE_CACHE["checked_at"] < COOKIE_CACHE_TTL_SECONDS:
+            COOKIE_CACHE["hits"] += 1
+            source = "cache"
+        else:
+            s3 = get_aws_client('s3')
+            conditions = {"IfNoneMatch": COOKIE_CACHE["etag"]} if cached else {}
+            try:
+                response = s3.get_object(Bucket=S3_COOKIES_BUCKET_NAME, Key=S3_COOKIES_KEY, **conditions)
+                with open(f"{COOKIE_CACHE_PATH}.part", 'wb') as f:
+                    shutil.copyfileobj(response['Body'], f)
+                os.replace(f"{COOKIE_CACHE_PATH}.part", COOKIE_CACHE_PATH)
+                COOKIE_CACHE["etag"] = response['ETag']
+                COOKIE_CACHE["downloads"] += 1
+                COOKIE_CACHE["fetch_seconds"] = time.time() - start
+                source = "S3"
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('304', 'NotModified'):
+                    raise
+                COOKIE_CACHE["revalidations"] += 1
+                source = "cache (revalidated)"
+            COOKIE_CACHE["checked_at"] = time.time()
+
+        shutil.copyfile(COOKIE_CACHE_PATH, cookie_file)
+
+    elapsed = time.time() - start
+    record_stage("cookies", elapsed)
+    saved = COOKIE_CACHE["fetch_seconds"] - elapsed if source != "S3" and COOKIE_CACHE["fetch_seconds"] else 0
+    COOKIE_CACHE["saved_seconds"] += max(saved, 0)
+    logger.info(f"Cookies from {source} in {elapsed * 1000:.0f} ms, ~{max(saved, 0) * 1000:.0f} ms saved before "
+                f"yt-dlp start ({COOKIE_CACHE['saved_seconds']:.2f} s saved by this container)")
+    return cookie_file
+
+
+class YtDlpLogger:
+    """
+    Forward the messages of the in-process yt-dlp engine to the Lambda logger
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def debug(self, message):
+        self.lines.append(message)
+
+    def info(self, message):
+        self.lines.append(message)
+
+    def warning(self, message):
+        logger.warning(f"yt-dlp: {message}")
+        self.lines.append(message)
+
+    def error(self, message):
+        logger.error(f"yt-dlp: {message}")
+        self.lines.append(message)
+
+
+def get_yt_dlp_module():
+    """
+    Import yt-dlp from its zipapp (YT_DLP_PATH) once per container for the in-process engine.
+    Return None when the subprocess engine must be used instead
+    """
+    if YT_DLP_ENGINE != "inprocess" or YT_DLP_MODULE["error"]:
+        return None
+    if YT_DLP_MODULE["module"] is None:
+        try:
+            start_time = time.time()
+            if YT_DLP_PATH not in sys.path:
+                sys.path.insert(0, YT_DLP_PATH)
+            import yt_dlp
+            YT_DLP_MODULE["module"] = yt_dlp
+            logger.info(f"yt-dlp {yt_dlp.version.__version__} imported in {time.time() - start_time:.2f} s")
+        except Exception as e:
+            YT_DLP_MODULE["error"] = str(e)
+            logger.warning(f"Unable to import yt-dlp, falling back to the subprocess engine: {e}")
+            return None
+    return YT_DLP_MODULE["module"]
+
+
+def get_yt_dlp_options(yt_dlp, args):
+    """
+    Turn yt-dlp command line arguments into YoutubeDL options, so both engines share the same arguments
+    """
+    try:
+        parsed = yt_dlp.parse_options(args)
+    except SystemExit as e:  # optparse exits on invalid arguments
+        raise Exception(f"Invalid yt-dlp arguments: {args}") from e
+    return parsed, {**parsed.ydl_opts, "logger": YtDlpLogger()}
+
+
+def get_yt_dlp_cache_files():
+    """
+    Return the files of the yt-dlp cache directory, as {relative path: (size, mtime)}
+    """
+    files = {}
+    for root, _, names in os.walk(YT_DLP_CACHE_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            files[os.path.relpath(path, YT_DLP_CACHE_DIR)] = (stat.st_size, stat.st_mtime)
+    return files
+
+
+def get_yt_dlp_cache_snapshot_key():
+    """
+    Snapshots are versioned by yt-dlp version, the cached player solutions don't carry over to other versions
+    """
+    version = get_ytdlp_version()
+    return f"{YT_DLP_CACHE_SNAPSHOT_PREFIX}{version}.zip" if version else None
+
+
+def restore_yt_dlp_cache():
+    """
+    Restore the yt-dlp cache directory from its S3 snapshot, once per container
+    """
+    YT_DLP_CACHE_STATS["restored"] = True
+    os.makedirs(YT_DLP_CACHE_DIR, exist_ok=True)
+    snapshot_key = get_yt_dlp_cache_snapshot_key()
+    if snapshot_key is None:
+        return
+    snapshot_path = f"{YT_DLP_CACHE_DIR}.zip"
+    try:
+        get_aws_client('s3').download_file(S3_YT_VIDEOS_BUCKET_NAME, snapshot_key, snapshot_path)
+        with zipfile.ZipFile(snapshot_path) as archive:
+            archive.extractall(YT_DLP_CACHE_DIR)
+        YT_DLP_CACHE_STATS["snapshot_files"] = get_yt_dlp_cache_files()
+        logger.info(f"yt-dlp cache restored from {snapshot_key} ({len(YT_DLP_CACHE_STATS['snapshot_files'])} files)")
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            logger.error(f"Error restoring the yt-dlp cache: {e}")
+        else:
+            logger.info(f"No yt-dlp cache snapshot for this version yet ({snapshot_key})")
+    finally:
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+
+
+def save_yt_dlp_cache(files):
+    """
+    Evict the oldest files above YT_DLP_CACHE_MAX_BYTES, then snapshot the yt-dlp cache directory to S3
+    """
+    total_size = sum(size for size, _ in files.values())
+    for name, (size, _) in sorted(files.items(), key=lambda item: item[1][1]):
+        if total_size <= YT_DLP_CACHE_MAX_BYTES:
+            break
+        os.remove(os.path.join(YT_DLP_CACHE_DIR, name))
+        del files[name]
+        total_size -= size
+        logger.info(f"Evicted {name} from the yt-dlp cache")
+
+    snapshot_key = get_yt_dlp_cache_snapshot_key()
+    if snapshot_key is None:
+        return
+    snapshot_path = f"{YT_DLP_CACHE_DIR}.zip"
+    try:
+        with zipfile.ZipFile(snapshot_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name in files:
+                archive.write(os.path.join(YT_DLP_CACHE_DIR, name), name)
+        get_aws_client('s3').upload_file(snapshot_path, S3_YT_VIDEOS_BUCKET_NAME, snapshot_key)
+        logger.info(f"yt-dlp cache snapshot saved to {snapshot_key} ({len(files)} files, {total_size} bytes)")
+    finally:
+        os.remove(snapshot_path)
+
+
+def begin_yt_dlp_cache():
+    """
+    Prepare the yt-dlp cache directory before a run, return its content to compare after the run
+    """
+    try:
+        if not YT_DLP_CACHE_STATS["restored"]:
+            restore_yt_dlp_cache()
+        return get_yt_dlp_cache_files()
+    except Exception as e:
+        logger.error(f"Error preparing the yt-dlp cache: {e}")
+        return None
+
+
+def end_yt_dlp_cache(files_before):
+    """
+    Count a hit if the run didn't add anything to the yt-dlp cache, a miss otherwise.
+    Nothing is written here, see persist_yt_dlp_cache
+    """
+    if files_before is None:
+        return
+    try:
+        hit = not set(get_yt_dlp_cache_files()) - set(files_before)
+        for counter in ("hits", "unsaved_hits") if hit else ("misses", "unsaved_misses"):
+            YT_DLP_CACHE_STATS[counter] += 1
+        hits, misses = YT_DLP_CACHE_STATS["hits"], YT_DLP_CACHE_STATS["misses"]
+        logger.info(f"yt-dlp cache {'hit' if hit else 'miss'} ({hits / (hits + misses) * 100:.0f}% hit rate "
+                    f"in this container)")
+    except Exception as e:
+        logger.error(f"Error checking the yt-dlp cache: {e}")
+
+
+def persist_yt_dlp_cache():
+    """
+    At the end of the invocation (after delivery), add the hits and misses of its yt-dlp runs to the
+    stats and snapshot the cache directory if its content changed since the last snapshot
+    """
+    hit, miss = YT_DLP_CACHE_STATS["unsaved_hits"], YT_DLP_CACHE_STATS["unsaved_misses"]
+    if not hit and not miss:
+        return
+    YT_DLP_CACHE_STATS["unsaved_hits"] = YT_DLP_CACHE_STATS["unsaved_misses"] = 0
+    try:
+        STATE_TABLE.update_item(
+            Key={'pk': "yt_dlp_cache#stats"},
+            UpdateExpression="ADD hits :hit, misses :miss",
+            ExpressionAttributeValues={':hit': hit, ':miss': miss})
+        files = get_yt_dlp_cache_files()
+        if files != YT_DLP_CACHE_STATS["snapshot_files"]:
+            save_yt_dlp_cache(files)  # Also drops the evicted files from files
+            YT_DLP_CACHE_STATS["snapshot_files"] = files
+    except Exception as e:
+        logger.error(f"Error saving the yt-dlp cache: {e}")
+
+
+def run_yt_dlp_extract(args):
+    """
+    Extract the metadata described by the yt-dlp arguments without downloading anything, return the info dict
+    """
+    args = ["--cache-dir", YT_DLP_CACHE_DIR, *args]
+    cache_files = begin_yt_dlp_cache()
+    try:
+        yt_dlp = get_yt_dlp_module()
+        if yt_dlp:
+            parsed, ydl_opts = get_yt_dlp_options(yt_dlp, args)
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(parsed.urls[0], download=False)
+            if not info:  # yt-dlp reports errors through the logger and returns nothing
+                raise Exception(f"yt-dlp extraction failed: {chr(10).join(ydl_opts['logger'].lines[-20:])}")
+            return ydl.sanitize_info(info)
+
+        command = [YT_DLP_PATH, *args, "--dump-single-json"]
+        logger.info(f"Executing command: {' '.join(command)}")
+        process = subprocess.run(command, capture_output=True, text=True)
+        if process.returncode != 0:
+            raise Exception(f"yt-dlp failed with return code {process.returncode}: {process.stderr}")
+        return json.loads(process.stdout)
+    finally:
+        end_yt_dlp_cache(cache_files)
+
+
+def run_yt_dlp_download(args, working_dir, extension, progress=None):
+    """
+    Download with the yt-dlp arguments, reporting to progress. Return the path of the final file
+    (with the in-process engine, from the result; with the subprocess one, the file of working_dir with this extension)
+    """
+    args = ["--cache-dir", YT_DLP_CACHE_DIR, *args]
+    cache_files = begin_yt_dlp_cache()
+    try:
+        yt_dlp = get_yt_dlp_module()
+        if yt_dlp:
+            parsed, ydl_opts = get_yt_dlp_options(yt_dlp, args)
+            ydl_opts["noprogress"] = True
+            if progress:
+                ydl_opts["progress_hooks"] = [progress.progress_hook]
+                ydl_opts["postprocessor_hooks"] = [progress.postprocessor_hook]
+            try:
+                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                    if parsed.options.load_info_filename:
+                        with open(parsed.options.load_info_filename, encoding='utf-8') as f:
+                            info = ydl.process_ie_result(ydl.sanitize_info(json.load(f)), download=True)
+                    else:
+                        info = ydl.extract_info(parsed.urls[0], download=True)
+            finally:
+                if progress:
+                    progress.finish()
+                logger.info(f"yt-dlp output: {chr(10).join(ydl_opts['logger'].lines)}")
+            if not info or not info.get("requested_downloads"):
+                raise Exception(f"yt-dlp download failed: {chr(10).join(ydl_opts['logger'].lines[-20:])}")
+            return info["requested_downloads"][0]["filepath"]
+
+        command = [YT_DLP_PATH, *args]
+        logger.info(f"Executing command: {' '.join(command)}")
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+        output_lines = []
+        for line in process.stdout:
+            if progress:
+                progress.feed_line(line)
+            if not line.startswith(PROGRESS_PREFIX):
+                output_lines.append(line)
+        process.wait()
+        if progress:
+            progress.finish()
+        logger.info(f"yt-dlp output: {''.join(output_lines)}")
+
+        if process.returncode != 0:
+            raise Exception(f"yt-dlp failed with return code {process.returncode}: {''.join(output_lines[-20:])}")
+
+        for file in os.listdir(working_dir):
+            if file.endswith(extension):
+                return os.path.join(working_dir, file)
+        return None
+    finally:
+        end_yt_dlp_cache(cache_files)
+
+
+def get_download_tuning(resolution):
+    """
+    Return the yt-dlp download settings (concurrent fragments, HTTP chunk and buffer sizes) suited to the
+    resources of this Lambda, with the overrides of the resolution applied
+    """
+    memory_mb = int(os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", LAMBDA_MEMORY_MB_PER_VCPU))
+    vcpus = min(os.cpu_count() or 1, max(memory_mb / LAMBDA_MEMORY_MB_PER_VCPU, 1))
+    free_tmp = shutil.disk_usage(WORKING_DIR).free
+
+    concurrent_fragments = min(round(vcpus * FRAGMENTS_PER_VCPU), memory_mb // MEMORY_MB_PER_FRAGMENT,
+                               free_tmp // (HTTP_CHUNK_SIZE * TMP_SPACE_MARGIN), MAX_CONCURRENT_FRAGMENTS)
+    tuning = {
+        "concurrent_fragments": max(int(concurrent_fragments), 1),
+        "http_chunk_size": HTTP_CHUNK_SIZE,
+        "buffer_size": 64 * 1024 if memory_mb >= 1024 else 16 * 1024}
+    tuning.update(DOWNLOAD_TUNING_OVERRIDES.get(resolution, {}))
+    logger.info(f"Download tuning for {resolution} ({memory_mb} MB, {vcpus:.1f} vCPU, "
+                f"{free_tmp / (1024 * 1024):.0f} MB free in /tmp): {tuning}")
+    return tuning
+
+
+def get_download_tuning_args(resolution):
+    tuning = get_download_tuning(resolution)
+    return [
+        "--concurrent-fragments", str(tuning["concurrent_fragments"]),
+        "--http-chunk-size", str(tuning["http_chunk_size"]),
+        "--buffer-size", str(tuning["buffer_size"])]
+
+
+def get_postprocessing_args(resolution, clip=False):
+    """
+    Return the yt-dlp arguments that shape the file of a resolution after its download (audio conversion,
+    merge, clip cuts). They are part of the download cache key, so that changing them invalidates the cache
+    """
+    if resolution in AUDIO_EXTENSIONS:
+        # m4a and opus streams are only remuxed, yt-dlp copies them when the codec already matches
+        args = ["--extract-audio", "--audio-format", resolution]
+        if resolution == "mp3":
+            args.extend(["--audio-quality", MP3_AUDIO_QUALITY])
+    else:
+        args = ["--merge-output-format", "mp4", "--postprocessor-args", f"Merger+ffmpeg_o:{FASTSTART_ARGS}"]
+    if clip and CLIP_FORCE_KEYFRAMES:
+        args.append("--force-keyframes-at-cuts")
+    return args
+
+
+def download_video(url, resolution, temp_dir=None, progress=None, info_file=None, section=None):
+    try:
+        working_dir = temp_dir or tempfile.mkdtemp(prefix="yt_dl_")
+        cookie_file = os.path.join(working_dir, "cookie.txt")
+        file_name = f"%(title)s ({format_clip_section(section)})" if section else "%(title)s"
+        output_path = os.path.join(working_dir, f"{file_name}.%(ext)s")
+
+        get_cookie_file(cookie_file)
+
+        format_string = FORMATS.get(resolution, FORMATS["medium"])
+
+        args = [
+            "--cookies", cookie_file,
+            "--output", output_path,
+            "--format", format_string,
+            *get_download_tuning_args(resolution),
+            "--newline",
+            "--progress-template", PROGRESS_TEMPLATE]
+
+        args.extend(get_postprocessing_args(resolution, clip=bool(section)))
+        if resolution not in AUDIO_EXTENSIONS:
+            args.extend([
+                "--ffmpeg-location", FFMPEG_PATH,
+                "--js-runtimes", f"deno:{DENO_PATH}"])
+
+        # Only the requested time range is downloaded (ffmpeg reads the needed part of the streams)
+        if section:
+            args.extend(["--download-sections", f"*{section[0]}-{section[1]}"])
+            if "--ffmpeg-location" not in args:
+                args.extend(["--ffmpeg-location", FFMPEG_PATH])
+
+        # Reuse the metadata of the preflight instead of extracting it again
+        args.extend(["--load-info-json", info_file] if info_file else [url])
+
+        extension = AUDIO_EXTENSIONS.get(resolution, ".mp4")
+        file_path = run_yt_dlp_download(args, working_dir, extension, progress=progress)
+        if file_path:
+            ensure_faststart(file_path)
+        return file_path
+    except Exception as e:
+        logger.error(f"Error in download_video: {str(e)}", exc_info=True)
+        return None
+
+
+def get_streaming_command(resolution, plan, cookie_file, name_file):
+    """
+    Return the command writing the media of the preflight plan to stdout and the file name, or (None, None) when
+    the selection isn't known. yt-dlp writes a single-file selection itself; a video+audio one is muxed by ffmpeg
+    from the stream URLs of the metadata, as a fragmented MP4 which needs no seeking back
+    """
+    if not plan or not plan.get("selected") or resolution in AUDIO_EXTENSIONS:
+        return None, None
+    info = plan["info"]
+    requested_formats = info.get("requested_formats") or []
+
+    if len(requested_formats) <= 1:
+        command = [
+            YT_DLP_PATH,
+            "--cookies", cookie_file,
+            "--cache-dir", YT_DLP_CACHE_DIR,
+            "--format", FORMATS[resolution],
+            *get_download_tuning_args(resolution),
+            "--js-runtimes", f"deno:{DENO_PATH}",
+            "--print-to-file", "%(title)s.%(ext)s", name_file,
+            "--newline",
+            "--progress-template", PROGRESS_TEMPLATE,
+            "--output", "-",
+            "--load-info-json", plan["info_file"]]
+        return command, None
+
+    command = [FFMPEG_PATH, "-hide_banner", "-xerror", "-loglevel", "warning", "-nostats", "-progress", "pipe:2"]
+    for fmt in requested_formats:
+        headers = "".join(f"{name}: {value}\r\n" for name, value in (fmt.get("http_headers") or {}).items())
+        if headers:
+            command.extend(["-headers", headers])
+        command.extend(["-i", fmt["url"]])
+    for index in range(len(requested_formats)):
+        command.extend(["-map", str(index)])
+    command.extend([*STREAMING_MUX_ARGS, "pipe:1"])
+    file_name = f"{info.get('title') or info.get('id')}.mp4".replace('/', '_')
+    return command, file_name
+
+
+def stop_streaming_process(process, stderr_thread=None):
+    """
+    Kill a streaming process that is still running (e.g. blocked writing to a stdout nobody reads anymore),
+    reap it and close its pipes, so that it doesn't outlive the job in a warm container
+    """
+    if process.poll() is None:
+        process.kill()
+    try:
+        process.wait(timeout=STREAMING_STOP_TIMEOUT_SECONDS)
+    except subprocess.TimeoutExpired:
+        logger.error(f"Streaming process {process.pid} didn't exit after being killed")
+    process.stdout.close()
+    # The reader gets EOF once the process is gone, its pipe is closed after it
+    if stderr_thread is not None:
+        stderr_thread.join(timeout=STREAMING_STOP_TIMEOUT_SECONDS)
+    process.stderr.close()
+
+
+def stream_video_to_s3(url, resolution, chat_id, first_name=None, last_name=None, temp_dir=None, progress=None,
+                       plan=None):
+    """
+    Pipe the download straight into an S3 multipart upload, without staging the file in /tmp.
+    Return the uploaded object's info, or None when the caller must fall back to the disk path
+    (no preflight of this resolution, or any failure). Always runs subprocesses, whose stdout is the file
+    """
+    writer = process = stderr_thread = None
+    cache_files = begin_yt_dlp_cache()
+    try:
+        working_dir = temp_dir or tempfile.mkdtemp(prefix="yt_dl_")
+        cookie_file = os.path.join(working_dir, "cookie.txt")
+        name_file = os.path.join(working_dir, "file_name.txt")
+
+        command_download, file_name = get_streaming_command(resolution, plan, cookie_file, name_file)
+        if not command_download:
+            return None
+        if file_name is None:
+            get_cookie_file(cookie_file)
+        format_id = "+".join(fmt.get("format_id") or "" for fmt in plan["info"].get("requested_formats") or [])
+
+        logger.info(f"Executing command: {' '.join(command_download)}")
+        process = subprocess.Popen(command_download, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        # Drain stderr (logs and progress) in the background so that the process never blocks on a full pipe
+        stderr_lines = []
+
+        def drain_stderr():
+            for raw_line in process.stderr:
+                line = raw_line.decode('utf-8', 'replace')
+                if line.startswith("total_size="):  # ffmpeg -progress, the size of the muxed output so far
+                    if progress:
+                        progress.update_download(format_id, parse_progress_number(line.split("=", 1)[1]),
+                                                 plan["estimated_size"], None, None)
+                    continue
+                if re.match(r"^\w+=", line):  # Other ffmpeg -progress fields
+                    continue
+                if progress:
+                    progress.feed_line(line)
+                if not line.startswith(PROGRESS_PREFIX):
+                    stderr_lines.append(line)
+
+        stderr_thread = threading.Thread(target=drain_stderr, daemon=True)
+        stderr_thread.start()
+
+        while True:
+            chunk = process.stdout.read(TELEGRAM_UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            if writer is None:
+                if file_name is None:
+                    # yt-dlp prints the file name before the first byte is written to stdout
+                    with open(name_file, encoding='utf-8') as f:
+                        file_name = f.read().strip().replace('/', '_')
+                s3_key = get_s3_key(chat_id, file_name, first_name, last_name)
+                writer = S3MultipartWriter(S3_YT_VIDEOS_BUCKET_NAME, s3_key,
+                                           ContentType=MEDIA_CONTENT_TYPES.get(os.path.splitext(file_name)[1],
+                                                                               "video/mp4"),
+                                           ContentDisposition=get_content_disposition(file_name))
+            writer.write(chunk)
+
+        process.wait()
+        stderr_thread.join()
+        if progress:
+            progress.finish()
+        if process.returncode != 0 or writer is None:
+            raise Exception(f"Streaming failed with return code {process.returncode}: {''.join(stderr_lines)}")
+
+        writer.close()
+        add_to_s3_manifest(writer.key, writer.bytes_written)
+        return {"s3_key": writer.key, "file_name": file_name, "size": writer.bytes_written}
+    except Exception as e:
+        logger.error(f"Error in stream_video_to_s3: {str(e)}", exc_info=True)
+        if process is not None:
+            stop_streaming_process(process, stderr_thread)
+        if writer is not None:
+            writer.abort()
+        return None
+    finally:
+        end_yt_dlp_cache(cache_files)
+
+
+def extract_video_info(url, resolution, working_dir):
+    """
+    Extract the metadata of a video without downloading it (yt-dlp -J).
+    resolution selects the format reported in requested_formats, None keeps yt-dlp's default
+    """
+    cookie_file = get_cookie_file(os.path.join(working_dir, "cookie.txt"))
+    args = [
+        "--cookies", cookie_file,
+        "--js-runtimes", f"deno:{DENO_PATH}",
+        "--no-playlist"]
+    if resolution:
+        args.extend(["--format", FORMATS[resolution]])
+    args.append(url)
+    return run_yt_dlp_extract(args)
+
+
+def estimate_download_size(info, resolution, selected=False, section=None):
+    """
+    Estimate the size in bytes of a download from its metadata. selected means the metadata was extracted
+    with the format of this resolution, so the formats chosen by yt-dlp are used, otherwise the choice is
+    approximated from the list of formats. A clip (section) counts for its share of the duration.
+    Return None when the size can't be estimated
+    """
+    duration = info.get('duration') or 0
+
+    def format_size(fmt):
+        # tbr is in kbit/s
+        return fmt.get('filesize') or fmt.get('filesize_approx') or (fmt.get('tbr') or 0) * 125 * duration
+
+    if resolution == "mp3":
+        size = duration * MP3_ESTIMATED_BYTES_PER_SECOND
+    elif selected:
+        size = sum(format_size(fmt) for fmt in info.get('requested_formats') or [info])
+    elif resolution in AUDIO_EXTENSIONS:
+        audios = [fmt for fmt in info.get('formats') or [] if fmt.get('vcodec') == 'none'
+                  and (fmt.get('ext') == 'm4a' if resolution == "m4a" else fmt.get('acodec') == 'opus')]
+        if not audios:
+            return None
+        size = format_size(max(audios, key=lambda fmt: fmt.get('abr') or fmt.get('tbr') or 0))
+    else:
+        max_height = re.search(r"height<=(\d+)", FORMATS[resolution])
+        formats = info.get('formats') or []
+        videos = [fmt for fmt in formats
+                  if fmt.get('vcodec') not in (None, 'none') and fmt.get('ext') == 'mp4'
+                  and (not max_height or (fmt.get('height') or 0) <= int(max_height.group(1)))]
+        audios = [fmt for fmt in formats if fmt.get('vcodec') == 'none' and fmt.get('acodec') not in (None, 'none')]
+        if not videos or not audios:
+            return None
+        video = max(videos, key=lambda fmt: (fmt.get('height') or 0, fmt.get('tbr') or 0))
+        audio = max(audios, key=lambda fmt: fmt.get('abr') or fmt.get('tbr') or 0)
+        size = format_size(video) + format_size(audio)
+
+    if section and duration:
+        size *= max(min(section[1], duration) - section[0], 0) / duration
+    return int(size) or None
+
+
+def pick_fit_resolution(info, section=None):
+    """
+    Return the best resolution whose estimated size can be sent in Telegram, the lowest one if none fits
+    """
+    max_size = TELEGRAM_MAX_UPLOAD_MB * 1024 * 1024 * FIT_SIZE_MARGIN
+    for resolution in FIT_RESOLUTIONS:
+        estimated_size = estimate_download_size(info, resolution, section=section)
+        logger.info(f"Estimated size in {resolution}: {estimated_size}")
+        if estimated_size is not None and estimated_size < max_size:
+            return resolution
+    return FIT_RESOLUTIONS[-1]
+
+
+def preflight_video(url, resolution, temp_dir, section=None):
+    """
+    Extract the metadata once before downloading, estimate the size and pick the delivery path
+    ("telegram" or "s3", None if unknown). "fit" is resolved to a real resolution here.
+    The info JSON is written to temp_dir for --load-info-json and kept in PREFLIGHT_CACHE, "selected" tells if
+    it was extracted with the format of this resolution (its requested_formats are the real selection).
+    Return the plan, or None if the metadata couldn't be extracted
+    """
+    try:
+        cache_key = get_video_id(url) or url
+        cached = PREFLIGHT_CACHE.get(cache_key)
+        if cached and time.time() - cached["extracted_at"] < PREFLIGHT_CACHE_TTL_SECONDS:
+            logger.info(f"Preflight metadata of {cache_key} reused from the container cache")
+        else:
+            extract_resolution = None if resolution == FIT_RESOLUTION else resolution
+            cached = {"info": extract_video_info(url, extract_resolution, temp_dir),
+                      "resolution": extract_resolution, "extracted_at": time.time()}
+            PREFLIGHT_CACHE.pop(cache_key, None)
+            PREFLIGHT_CACHE[cache_key] = cached
+            while len(PREFLIGHT_CACHE) > PREFLIGHT_CACHE_MAX_ENTRIES:
+                PREFLIGHT_CACHE.pop(next(iter(PREFLIGHT_CACHE)))
+
+        info = cached["info"]
+        if resolution == FIT_RESOLUTION:
+            resolution = pick_fit_resolution(info, section)
+        estimated_size = estimate_download_size(info, resolution, selected=(resolution == cached["resolution"]),
+                                                section=section)
+        if estimated_size is None:
+            delivery = None
+        elif estimated_size < TELEGRAM_MAX_UPLOAD_MB * 1024 * 1024:
+            delivery = "telegram"
+        else:
+            delivery = "s3"
+
+        info_file = os.path.join(temp_dir, "info.json")
+        with open(info_file, 'w', encoding='utf-8') as f:
+            json.dump(info, f)
+
+        logger.info(f"Preflight of {cache_key}: resolution {resolution}, estimated size {estimated_size}, "
+                    f"delivery {delivery}")
+        return {"resolution": resolution, "estimated_size": estimated_size, "delivery": delivery,
+                "info": info, "info_file": info_file, "selected": resolution == cached["resolution"]}
+    except Exception as e:
+        logger.error(f"Error in preflight_video: {str(e)}", exc_info=True)
+        return None
+
+
+def parse_clip_time(value):
+    """
+    Convert [h:]m:s or plain seconds to seconds, None if a minute or second field is over 59
+    """
+    fields = [int(field) for field in value.split(':')]
+    if any(field > 59 for field in fields[1:]):
+        return None
+    seconds = 0
+    for field in fields:
+        seconds = seconds * 60 + field
+    return seconds
+
+
+def parse_clip_section(value):
+    """
+    Parse a "start-end" time range, return (start, end) in seconds or None if it isn't a valid range
+    """
+    match = CLIP_PATTERN.match(value)
+    if not match:
+        return None
+    start, end = parse_clip_time(match.group(1)), parse_clip_time(match.group(2))
+    if start is None or end is None or start >= end:
+        return None
+    return start, end
+
+
+def format_clip_section(section):
+    """
+    Label of a clip used in file names and cache keys, e.g. 12m30s-13m10s
+    """
+    def format_time(seconds):
+        hours, minutes, seconds = seconds // 3600, seconds // 60 % 60, seconds % 60
+        if hours:
+            return f"{hours}h{minutes:02d}m{seconds:02d}s"
+        return f"{minutes}m{seconds:02d}s" if minutes else f"{seconds}s"
 
-    # If the file size is less than 50MB, send it directly
-    if file_size_mb < 50:
-        logger.info(f"File is {file_size_mb:.2f}MB, sending directly")
-        if file_name.endswith('.mp3'):
-            url = f"https://api.telegram.org/bot{get_secret_bot_token()}/sendAudio"
-            with open(file_path, 'rb') as audio:
-                audio_data = audio.read()
-            fields = {"chat_id": str(chat_id), "audio": (file_name, audio_data, "audio/mp3")}
-        else:
-            url = f"https://api.telegram.org/bot{get_secret_bot_token()}/sendVideo"
-            with open(file_path, 'rb') as video:
-                video_data = video.read()
-            fields = {"chat_id": str(chat_id), "video": (file_name, video_data, "video/mp4")}
+    return f"{format_time(section[0])}-{format_time(section[1])}"
 
-        response = HTTP.request('POST', url, fields=fields)
-        logger.info(f"Response of the POST request: {response.data}")
 
-    # If the file size is 50MB or more, zip it, upload to S3 and send the link
-    else:
-        logger.info(f"File is {file_size_mb:.2f}MB, zipping, uploading to S3 and sending link")
+def get_video_id(url):
+    """
+    Extract the canonical YouTube video ID from the different URL forms, None for other URLs
+    """
+    match = YOUTUBE_ID_PATTERN.search(url)
+    return match.group(1) if match else None
 
-        media = "audio/music" if file_name.endswith('.mp3') else "video"
 
-        zip_file_path = zip_file(file_path)
-        s3_key = upload_file_to_s3(zip_file_path, chat_id, first_name, last_name)
-        if s3_key:
-            file_url = generate_url(s3_key)
-            if file_url:
-                msg = f"Here's your {media} (as a zip file) 🍿\n\n{file_name}\n{file_size_mb:.2f} MB\n\n{file_url}"
-                send_message(chat_id, msg)
-                logger.info(f"{media} uploaded to S3 and link sent to user")
-            else:
-                logger.error("Failed to generate pre-signed URL")
-                send_message(chat_id, "Sorry, there was an error creating the download URL 🥲")
+def get_ytdlp_version():
+    """
+    Return the yt-dlp version, read only once per container (from the loaded module with the in-process engine)
+    """
+    if YT_DLP_VERSION["version"] is None and get_yt_dlp_module():
+        YT_DLP_VERSION["version"] = get_yt_dlp_module().version.__version__
+    if YT_DLP_VERSION["version"] is None:
+        process = subprocess.run([YT_DLP_PATH, "--version"], capture_output=True, text=True)
+        if process.returncode != 0:
+            logger.error(f"yt-dlp version check failed: {process.stderr}")
+            return None
+        YT_DLP_VERSION["version"] = process.stdout.strip()
+    return YT_DLP_VERSION["version"]
 
-            os.remove(zip_file_path)
-        else:
-            logger.error(f"Failed to upload {media} to S3")
-            send_message(chat_id, f"Sorry, there was an error sending the {media} to the server 🥲")
 
-    os.remove(file_path)
+def get_download_cache_id(video_id, resolution):
+    """
+    Derive the cache entry ID from the video ID, the format string, the post-processing arguments
+    (e.g. the MP3 quality) and the yt-dlp version
+    """
+    version = get_ytdlp_version()
+    if version is None:
+        return None
+    postprocessing = " ".join(get_postprocessing_args(resolution, clip="#" in video_id))  # Clip IDs end with #start-end
+    cache_key = f"{video_id}|{FORMATS[resolution]}|{postprocessing}|{version}"
+    return hashlib.sha256(cache_key.encode('utf-8')).hexdigest()
 
 
-def download_video(url, resolution, temp_dir=None):
+def lookup_download_cache(video_id, resolution):
+    """
+    Return the cache entry of a previous download of this video at this resolution, or None
+    """
     try:
-        working_dir = temp_dir or tempfile.mkdtemp(prefix="yt_dl_")
-        cookie_file = os.path.join(working_dir, "cookie.txt")
-        output_path = os.path.join(working_dir, "%(title)s.%(ext)s")
-
-        s3 = boto3.client('s3')
-        s3.download_file(S3_COOKIES_BUCKET_NAME, S3_COOKIES_KEY, cookie_file)
-
-        format_string = FORMATS.get(resolution, FORMATS["medium"])
+        cache_id = get_download_cache_id(video_id, resolution)
+        if cache_id is None:
+            return None
+        item = STATE_TABLE.get_item(Key={'pk': f"cache#{cache_id}"}).get('Item')
+        # Expired items can outlive their TTL until DynamoDB deletes them
+        hit = item is not None and int(item['expires_at']) > time.time()
+        DOWNLOAD_CACHE_STATS["hits" if hit else "misses"] += 1
+        STATE_TABLE.update_item(
+            Key={'pk': "cache#stats"},
+            UpdateExpression="ADD hits :hit, misses :miss",
+            ExpressionAttributeValues={':hit': int(hit), ':miss': int(not hit)})
+        if not hit:
+            return None
+
+        STATE_TABLE.update_item(
+            Key={'pk': f"cache#{cache_id}"},
+            UpdateExpression="SET last_access = :now",
+            ExpressionAttributeValues={':now': int(time.time())})
+        logger.info(f"Download cache hit for {video_id} ({resolution}): {item['s3_key']}")
+        return item
+    except ClientError as e:
+        logger.error(f"Error looking up the download cache: {e}")
+        return None
 
-        command_download = [
-            YT_DLP_PATH,
-            "--cookies", cookie_file,
-            "--output", output_path,
-            "--format", format_string]
 
-        if resolution == "mp3":
-            command_download.extend([
-                "--extract-audio",
-                "--audio-format", "mp3"])
-        else:
-            command_download.extend([
-                "--ffmpeg-location", FFMPEG_PATH,
-                "--js-runtimes", f"deno:{DENO_PATH}",
-                "--merge-output-format", "mp4"])
+def store_in_download_cache(video_id, resolution, file_path):
+    """
+    Upload a downloaded file to the shared cache and index it. Return its S3 key, None on error
+    """
+    try:
+        cache_id = get_download_cache_id(video_id, resolution)
+        if cache_id is None:
+            return None
+        file_name = os.path.basename(file_path)
+        s3_key = f"{DOWNLOAD_CACHE_PREFIX}{cache_id}"
+        file_size = os.path.getsize(file_path)
+        content_type = MEDIA_CONTENT_TYPES.get(os.path.splitext(file_name)[1], "application/octet-stream")
+
+        s3 = get_aws_client('s3')
+        s3.upload_file(file_path, S3_YT_VIDEOS_BUCKET_NAME, s3_key, ExtraArgs={"ContentType": content_type})
+
+        now = int(time.time())
+        STATE_TABLE.put_item(Item={
+            'pk': f"cache#{cache_id}",
+            's3_key': s3_key,
+            'file_name': file_name,
+            'size': file_size,
+            'video_id': video_id,
+            'resolution': resolution,
+            'cache': "download",  # Partition of DOWNLOAD_CACHE_INDEX
+            'last_access': now,
+            'expires_at': now + DOWNLOAD_CACHE_TTL_DAYS * 86400})
+        response = STATE_TABLE.update_item(
+            Key={'pk': "cache#stats"},
+            UpdateExpression="ADD total_bytes :size",
+            ExpressionAttributeValues={':size': file_size},
+            ReturnValues="UPDATED_NEW")
+        logger.info(f"Stored {file_name} in the download cache: {s3_key}")
+
+        if response['Attributes']['total_bytes'] > DOWNLOAD_CACHE_MAX_BYTES:
+            evict_download_cache()
+        return s3_key
+    except ClientError as e:
+        logger.error(f"Error storing in the download cache: {e}")
+        return None
 
-        command_download.append(url)
 
-        logger.info(f"Executing command: {' '.join(command_download)}")
-        process = subprocess.run(command_download, capture_output=True, text=True)
-        logger.info(f"yt-dlp stdout: {process.stdout}")
+def evict_download_cache():
+    """
+    Delete the least recently used cache entries until the cache is back under 90% of DOWNLOAD_CACHE_MAX_BYTES.
+    The entries are read from DOWNLOAD_CACHE_INDEX, oldest access first, rather than from a scan of the table
+    which also holds the updates, playlist jobs and history cursors
+    """
+    entries = []
+    query_kwargs = {
+        'IndexName': DOWNLOAD_CACHE_INDEX,
+        'KeyConditionExpression': "#cache = :download",
+        'ExpressionAttributeValues': {':download': "download"},
+        'ProjectionExpression': "pk, s3_key, #size, last_access",
+        'ExpressionAttributeNames': {'#cache': "cache", '#size': "size"}}
+    while True:
+        response = STATE_TABLE.query(**query_kwargs)
+        entries.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    total_bytes = sum(int(entry['size']) for entry in entries)
+    s3 = get_aws_client('s3')
+    evicted = 0
+    for entry in entries:
+        if total_bytes <= DOWNLOAD_CACHE_MAX_BYTES * 0.9:
+            break
+        s3.delete_object(Bucket=S3_YT_VIDEOS_BUCKET_NAME, Key=entry['s3_key'])
+        STATE_TABLE.delete_item(Key={'pk': entry['pk']})
+        total_bytes -= int(entry['size'])
+        evicted += 1
+
+    # Resynchronise the running total, which drifts when DynamoDB expires entries
+    STATE_TABLE.update_item(
+        Key={'pk': "cache#stats"},
+        UpdateExpression="SET total_bytes = :total",
+        ExpressionAttributeValues={':total': total_bytes})
+    logger.info(f"Evicted {evicted} download cache entries, {total_bytes} bytes left")
+
+
+def copy_from_download_cache(cache_s3_key, file_name, file_size, chat_id, first_name=None, last_name=None):
+    """
+    Copy a cached file server-side into the user's folder, as a raw media file. Return its S3 key
+    """
+    s3 = get_aws_client('s3')
+    s3_key = get_s3_key(chat_id, file_name, first_name, last_name)
+    s3.copy({'Bucket': S3_YT_VIDEOS_BUCKET_NAME, 'Key': cache_s3_key}, S3_YT_VIDEOS_BUCKET_NAME, s3_key,
+            ExtraArgs={
+                "ContentType": MEDIA_CONTENT_TYPES.get(os.path.splitext(file_name)[1], "application/octet-stream"),
+                "ContentDisposition": get_content_disposition(file_name),
+                "MetadataDirective": "REPLACE"})
+    add_to_s3_manifest(s3_key, file_size)
+    return s3_key
 
-        if process.returncode != 0:
-            raise Exception(f"yt-dlp failed with return code {process.returncode}: {process.stderr}")
 
-        if process.returncode == 0:
-            if resolution == "mp3":
-                for file in os.listdir(working_dir):
-                    if file.endswith(".mp3"):
-                        return os.path.join(working_dir, file)
-            else:
-                for file in os.listdir(working_dir):
-                    if file.endswith(".mp4"):
-                        return os.path.join(working_dir, file)
-    except Exception as e:
-        logger.error(f"Error in download_video: {str(e)}", exc_info=True)
-        return None
+def serve_from_download_cache(chat_id, entry, temp_dir, first_name=None, last_name=None, resolution=None):
+    """
+    Deliver a cached download like a fresh one: the file is fetched back and sent through send_video_or_link
+    (Telegram, parts or a packaged S3 link). Only a large file sent as a raw link is copied server-side into
+    the user's folder instead, the result is the same
+    """
+    s3 = get_aws_client('s3')
+    file_name = entry['file_name']
+    file_size_mb = int(entry['size']) / (1024 * 1024)
+    try:
+        if file_size_mb >= TELEGRAM_MAX_UPLOAD_MB and S3_PACKAGING == "raw" and LARGE_FILE_DELIVERY == "link":
+            s3_key = copy_from_download_cache(entry['s3_key'], file_name, int(entry['size']), chat_id, first_name,
+                                              last_name)
+            media = "audio/music" if os.path.splitext(file_name)[1] in AUDIO_EXTENSIONS.values() else "video"
+            return send_download_link(chat_id, s3_key, file_name, file_size_mb, media)
+
+        file_path = os.path.join(temp_dir, file_name)
+        s3.download_file(S3_YT_VIDEOS_BUCKET_NAME, entry['s3_key'], file_path)
+        send_video_or_link(chat_id, file_path, first_name, last_name, entry['video_id'], resolution)
+        return True
+    except ClientError as e:
+        logger.error(f"Error serving from the download cache: {e}")
+        return False
 
 
-def list_s3_videos(chat_id, first_name=None, last_name=None):
-    """
-    List all videos in the S3 bucket for the specific chat_id
-    """
-    s3 = boto3.client('s3')
-    try:
-        prefix = f"{chat_id}"
-        if first_name:
-            prefix += f"_{first_name}"
-        if last_name:
-            prefix += f"_{last_name}"
-        prefix += "/"
-        response = s3.list_objects_v2(Bucket=S3_YT_VIDEOS_BUCKET_NAME, Prefix=prefix)
-        if 'Contents' in response:
-            videos = []
-            for obj in response['Contents']:
-                key = obj['Key']
-                # Extract just the filename (without the chat_id/ prefix)
-                file_name = key.split('/', 1)[1]
-                size_mb = obj['Size'] / (1024 * 1024)  # Convert to MB
-                videos.append(f"{file_name} ({size_mb:.2f} MB)")
-            return videos
-        else:
-            return []
+def list_s3_videos(chat_id, first_name=None, last_name=None, sort_by="date", rebuild=False):
+    """
+    List all videos of the specific chat_id from the manifest of its folder (a Query, no S3 listing),
+    newest first or largest first
+    """
+    folder = get_s3_folder(chat_id, first_name, last_name)
+    try:
+        # Folders never listed since the manifest exists are indexed from S3 first
+        indexed = not rebuild and 'Item' in STATE_TABLE.get_item(Key={'pk': f"manifest#{folder}"})
+        files = get_s3_manifest(folder) if indexed else rebuild_s3_manifest(folder)
     except ClientError as e:
         logger.error(f"Error listing S3 objects: {e}")
         return None
 
+    sort_field = 'size' if sort_by == "size" else 'last_modified'
+    videos = []
+    for file_name, entry in sorted(files.items(), key=lambda f: int(f[1][sort_field]), reverse=True):
+        size_mb = int(entry['size']) / (1024 * 1024)  # Convert to MB
+        videos.append(f"{file_name} ({size_mb:.2f} MB)")
+    return videos
+
 
 def delete_s3_video(chat_id, file_name, first_name=None, last_name=None):
     """
     Delete a specific video from the S3 bucket for the specific chat_id
     """
-    s3 = boto3.client('s3')
+    s3 = get_aws_client('s3')
     s3_key = get_s3_key(chat_id, file_name, first_name, last_name)
 
     try:
-        # Check if the file exists
-        response = s3.list_objects_v2(Bucket=S3_YT_VIDEOS_BUCKET_NAME, Prefix=s3_key)
-        file_exists = 'Contents' in response and len(response['Contents']) > 0
-
-        if not file_exists:
-            return False
+        # Check if the file exists (a single HEAD, S3 deletes of missing keys succeed silently)
+        s3.head_object(Bucket=S3_YT_VIDEOS_BUCKET_NAME, Key=s3_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            logger.error(f"Error checking S3 object {s3_key}: {e}")
+        return False
 
+    try:
         # The file exists, we can delete it
         s3.delete_object(Bucket=S3_YT_VIDEOS_BUCKET_NAME, Key=s3_key)
+        remove_from_s3_manifest(s3_key)
         return True
     except ClientError as e:
         print(f"*** Error deleting S3 object: {e}")
         return False
 
 
-def delete_all_s3_zips(chat_id, first_name=None, last_name=None):
+def delete_s3_keys(keys):
     """
-    Delete all zip files from the S3 bucket for the specific chat_id
+    Delete S3 keys by batches of S3_DELETE_BATCH_SIZE (DeleteObjects). Return the keys that couldn't be deleted
     """
-    s3 = boto3.client('s3')
-    try:
-        # Build the prefix for the user's folder
-        prefix = f"{chat_id}"
-        if first_name:
-            prefix += f"_{first_name}"
-        if last_name:
-            prefix += f"_{last_name}"
-        prefix += "/"
-
-        # List all objects in the user's folder
-        response = s3.list_objects_v2(Bucket=S3_YT_VIDEOS_BUCKET_NAME, Prefix=prefix)
-
-        if 'Contents' not in response:
-            return 0
-
-        # Filter and delete only .zip files
-        deleted_count = 0
-        for obj in response['Contents']:
-            key = obj['Key']
-            if key.endswith('.zip'):
-                s3.delete_object(Bucket=S3_YT_VIDEOS_BUCKET_NAME, Key=key)
-                deleted_count += 1
-                logger.info(f"Deleted zip file: {key}")
+    s3 = get_aws_client('s3')
+    failed = []
+    for i in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+        batch = keys[i:i + S3_DELETE_BATCH_SIZE]
+        response = s3.delete_objects(
+            Bucket=S3_YT_VIDEOS_BUCKET_NAME,
+            Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+        failed.extend(error['Key'] for error in response.get('Errors', []))
+    for key in failed:
+        logger.error(f"Error deleting S3 file: {key}")
+    return failed
+
+
+def delete_s3_files(chat_id, first_name=None, last_name=None, pattern=None, older_than_seconds=None):
+    """
+    Delete the files of the user's folder matching a glob pattern on the file name (by default
+    the zip and media files) and, optionally, older than a given age. Keys are listed page by
+    page and deleted by batches of 1000. Return the number of deleted files, -1 on error
+    """
+    s3 = get_aws_client('s3')
+    folder = get_s3_folder(chat_id, first_name, last_name)
+    prefix = f"{folder}/"
+    cutoff = time.time() - older_than_seconds if older_than_seconds else None
 
-        return deleted_count
+    try:
+        to_delete = []
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=S3_YT_VIDEOS_BUCKET_NAME, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                file_name = obj['Key'][len(prefix):]
+                matches = fnmatch.fnmatch(file_name, pattern) if pattern else file_name.endswith(S3_DELETABLE_EXTENSIONS)
+                if matches and (cutoff is None or obj['LastModified'].timestamp() < cutoff):
+                    to_delete.append(obj['Key'])
+
+        failed = delete_s3_keys(to_delete)
+        deleted_count = len(to_delete) - len(failed)
+        logger.info(f"Deleted {deleted_count} file(s) from {prefix} in {-(-len(to_delete) // S3_DELETE_BATCH_SIZE)} batch(es)")
+
+        remove_from_s3_manifest(*set(to_delete).difference(failed))
+        return deleted_count if not failed else -1
     except ClientError as e:
-        logger.error(f"Error deleting S3 zip files: {e}")
+        logger.error(f"Error deleting S3 files: {e}")
         return -1
 
 
 def send_cloudwatch_dl_error(chat_id):
     """
-    Send a metric to CloudWatch to track download errors
+    Send a metric to CloudWatch to track download errors (EMF, without dimensions like the alarm expects)
     """
 
-    cloudwatch.put_metric_data(
-        Namespace='YTDownloader_app',
-        MetricData=[
-            {
-                'MetricName': 'DownloadError',
-                'Value': 1,
-                'Unit': 'Count'
-            },
-        ]
-    )
+    emit_metrics({"DownloadError": (1, "Count")})
 
     msg = "🤖 Download failed, I need to be updated, my admin Tim has been notified 🔔"
     send_message(chat_id, msg)
 
 
-def process_video_download(chat_id, url, resolution, first_name=None, last_name=None):
+def store_for_bundle(file_path, bundle_prefix, cached=None):
+    """
+    Put a playlist entry in the bundle folder, from the download cache (server-side copy) or from disk
+    """
+    s3 = get_aws_client('s3')
+    try:
+        if cached:
+            s3.copy({'Bucket': S3_YT_VIDEOS_BUCKET_NAME, 'Key': cached['s3_key']}, S3_YT_VIDEOS_BUCKET_NAME,
+                    f"{bundle_prefix}{cached['file_name']}")
+        else:
+            s3.upload_file(file_path, S3_YT_VIDEOS_BUCKET_NAME, f"{bundle_prefix}{os.path.basename(file_path)}")
+        return True
+    except ClientError as e:
+        logger.error(f"Error storing playlist entry in {bundle_prefix}: {e}")
+        return False
+
+
+def process_video_download(chat_id, url, resolution, first_name=None, last_name=None, quiet=False,
+                           bundle_prefix=None, section=None):
     """
-    Function to handle the video download process asynchronously
+    Function to handle the video download process asynchronously.
+    quiet skips the status messages (playlist entries), bundle_prefix stores the file in S3 under
+    that prefix instead of delivering it, section (start, end) in seconds downloads only that clip.
+    Return True if the video was delivered or stored
     """
 
     logger.info(f"Starting video download for chat_id: {chat_id}, url: {url}, resolution: {resolution}")
 
-    send_message(chat_id, "Download in progress, please wait... 🔄")
+    message_id = None if quiet else send_message(chat_id, "Download in progress, please wait... 🔄")
+    progress = DownloadProgress(make_progress_notifier(chat_id, message_id))
     temp_dir = tempfile.mkdtemp(prefix="yt_dl_")
+    metrics = JobMetrics("download", Resolution=resolution, Delivery="failed")
+    JOB_METRICS["current"] = metrics
+    video_id = get_video_id(url)
+    if video_id and section:
+        # Clips are cached and resent by file_id as media of their own
+        video_id = f"{video_id}#{format_clip_section(section)}"
 
     try:
-        file_path = download_video(url, resolution, temp_dir=temp_dir)
+        # "fit" needs the metadata to know which resolution to look up and download
+        plan = None
+        if resolution == FIT_RESOLUTION:
+            with timed_stage("preflight"):
+                plan = preflight_video(url, resolution, temp_dir, section)
+            resolution = plan["resolution"] if plan else FIT_RESOLUTIONS[-1]
+            metrics.dimensions["Resolution"] = resolution
+            logger.info(f"Resolution picked to fit in Telegram: {resolution}")
+
+        if video_id and TELEGRAM_FILE_ID_REUSE and not bundle_prefix:
+            with timed_stage("file_id"):
+                sent = send_by_telegram_file_id(chat_id, video_id, resolution)
+            if sent:
+                metrics.dimensions["Delivery"] = "file_id"
+                return True
+
+        if video_id and DOWNLOAD_CACHE_ENABLED:
+            with timed_stage("cache_lookup"):
+                cached = lookup_download_cache(video_id, resolution)
+            if cached and bundle_prefix:
+                metrics.dimensions["Delivery"] = "bundle"
+                with timed_stage("bundle"):
+                    return store_for_bundle(None, bundle_prefix, cached=cached)
+            if cached:
+                with timed_stage("cache_serve"):
+                    served = serve_from_download_cache(chat_id, cached, temp_dir, first_name, last_name, resolution)
+                if served:
+                    metrics.dimensions["Delivery"] = "cache"
+                    return True
+
+        if plan is None and PREFLIGHT_ENABLED:
+            with timed_stage("preflight"):
+                plan = preflight_video(url, resolution, temp_dir, section)
+        info_file = plan["info_file"] if plan else None
+        duration = plan["info"].get("duration") if plan else None
+        if section and duration and section[0] >= duration:
+            if not quiet:
+                send_message(chat_id, f"The clip starts after the end of the video ({int(duration)} s) 🤔")
+            return False
+        if plan and plan["delivery"] == "s3" and message_id is not None:
+            estimated_size_mb = plan["estimated_size"] / (1024 * 1024)
+            edit_message(chat_id, message_id, f"Download in progress (about {estimated_size_mb:.0f} MB, you will get "
+                                              "a download link), please wait... 🔄")
+
+        # Files known to fit in Telegram are never streamed, they must be on disk to be sent
+        if resolution in STREAMING_UPLOAD_RESOLUTIONS and not bundle_prefix and not section and not (
+                plan and plan["delivery"] == "telegram"):
+            with timed_stage("stream_to_s3") as stage:
+                streamed = stream_video_to_s3(url, resolution, chat_id, first_name, last_name, temp_dir=temp_dir,
+                                              progress=progress, plan=plan)
+                stage["bytes"] = streamed["size"] if streamed else None
+            if streamed:
+                metrics.dimensions["Delivery"] = "stream"
+                with timed_stage("telegram_message"):
+                    send_download_link(chat_id, streamed["s3_key"], streamed["file_name"],
+                                       streamed["size"] / (1024 * 1024), "video")
+                return True
+            logger.info("Streaming delivery not possible, falling back to the disk path")
+
+        with timed_stage("yt-dlp") as stage:
+            file_path = download_video(url, resolution, temp_dir=temp_dir, progress=progress, info_file=info_file,
+                                       section=section)
+            stage["bytes"] = os.path.getsize(file_path) if file_path else None
 
         if file_path:
-            send_video_or_link(chat_id, file_path, first_name, last_name)
-        else:
-            logger.error(f"Error in process_video_download for chat_id: {chat_id}, url: {url}, resolution: {resolution}")
+            if message_id is not None:
+                edit_message(chat_id, message_id, "Download complete, sending it to you... 📤")
+            cache = bool(video_id) and DOWNLOAD_CACHE_ENABLED
+            if bundle_prefix:
+                metrics.dimensions["Delivery"] = "bundle"
+                with timed_stage("bundle"):
+                    stored = store_for_bundle(file_path, bundle_prefix)
+                if cache:
+                    with timed_stage("cache_store") as stage:
+                        store_in_download_cache(video_id, resolution, file_path)
+                        stage["bytes"] = os.path.getsize(file_path)
+                return stored
+            send_video_or_link(chat_id, file_path, first_name, last_name, video_id, resolution, cache=cache)
+            return True
+
+        logger.error(f"Error in process_video_download for chat_id: {chat_id}, url: {url}, resolution: {resolution}")
+        if not quiet:
             send_cloudwatch_dl_error(chat_id)
+        return False
     finally:
+        # yt-dlp's own stages (fragments download, merge, audio extraction) as sub-stages of yt-dlp
+        for stage in progress.summary():
+            name = "download" if stage["stage"].startswith("download") else stage["stage"]
+            metrics.add_stage(f"yt-dlp {name}", stage["seconds"], stage["bytes"])
+        JOB_METRICS["current"] = None
+        metrics.emit()
         try:
             shutil.rmtree(temp_dir, ignore_errors=True)
             logger.info(f"Cleaned up temp directory: {temp_dir}")
@@ -418,11 +2442,339 @@ def process_video_download(chat_id, url, resolution, first_name=None, last_name=
             logger.error(f"Failed to clean up temp directory {temp_dir}: {e}")
 
 
+def expand_playlist(url):
+    """
+    List the entries of a playlist with a flat (metadata only) extraction
+    """
+    working_dir = tempfile.mkdtemp(prefix="yt_dl_playlist_")
+    try:
+        cookie_file = get_cookie_file(os.path.join(working_dir, "cookie.txt"))
+        playlist = run_yt_dlp_extract([
+            "--cookies", cookie_file,
+            "--flat-playlist",
+            "--playlist-end", str(PLAYLIST_MAX_ITEMS),
+            url])
+        entries = [entry.get('url') or f"https://www.youtube.com/watch?v={entry['id']}"
+                   for entry in playlist.get('entries', []) if entry]
+        return playlist.get('title') or playlist.get('id') or "playlist", entries
+    finally:
+        shutil.rmtree(working_dir, ignore_errors=True)
+
+
+def get_playlist_entry_key(job_key, index):
+    return f"{job_key}#entry#{int(index)}"
+
+
+def dispatch_playlist_entry(job, index):
+    """
+    Record the entry as dispatched, then invoke its download. The record is claimed by the invocation
+    (see claim_playlist_entry) so that Lambda's retries of it are counted once
+    """
+    now = int(time.time())
+    STATE_TABLE.put_item(Item={
+        'pk': get_playlist_entry_key(job['pk'], index),
+        'status': "dispatched",
+        'attempts': 0,
+        'lease_until': now + JOB_LOCK_TTL_SECONDS,
+        'expires_at': now + PLAYLIST_JOB_TTL_SECONDS})
+    payload = {
+        'type': 'process_video',
+        'chat_id': job['chat_id'],
+        'first_name': job.get('first_name'),
+        'last_name': job.get('last_name'),
+        'url': job['entries'][index],
+        'resolution': job['resolution'],
+        'playlist_job': job['pk'],
+        'entry_index': int(index),
+        'bundle_prefix': job.get('bundle_prefix')}
+    invoke_lambda_async(payload)
+
+
+def process_playlist_download(chat_id, url, resolution, bundle=False, first_name=None, last_name=None):
+    """
+    Expand a playlist and fan its entries out to parallel Lambda invocations, PLAYLIST_CONCURRENCY at a time.
+    Each finished entry dispatches the next one, the last one sends the summary (see playlist_entry_done)
+    """
+    try:
+        title, entries = expand_playlist(url)
+    except Exception as e:
+        logger.error(f"Error expanding playlist {url}: {e}", exc_info=True)
+        send_message(chat_id, "❌ Unable to read this playlist 🥲")
+        return
+    if not entries:
+        send_message(chat_id, "ℹ️ This playlist is empty 📭")
+        return
+
+    job_id = uuid.uuid4().hex
+    initial = min(PLAYLIST_CONCURRENCY, len(entries))
+    job = {
+        'pk': f"playlist#{job_id}",
+        'chat_id': chat_id,
+        'first_name': first_name,
+        'last_name': last_name,
+        'title': title,
+        'resolution': resolution,
+        'entries': entries,
+        'total': len(entries),
+        'dispatched': initial,
+        'pending': set(range(initial)),
+        'completed': 0,
+        'failed': 0,
+        'expires_at': int(time.time()) + PLAYLIST_JOB_TTL_SECONDS}
+    if bundle:
+        job['bundle_prefix'] = get_s3_key(chat_id, f"playlist_{job_id}/", first_name, last_name)
+    STATE_TABLE.put_item(Item=job)
+
+    send_message(chat_id, f"📃 Downloading {len(entries)} videos from \"{title}\", please wait... 🔄")
+    for index in range(initial):
+        dispatch_playlist_entry(job, index)
+
+
+def claim_playlist_entry(job_key, index, lease_seconds):
+    """
+    Claim a playlist entry for this invocation until lease_seconds, the time left to it. Return the attempt
+    number, or None if the entry was already counted or another invocation is processing it. The claim of a
+    timed out invocation is taken over by Lambda's retry once its lease is over
+    """
+    now = int(time.time())
+    try:
+        return int(STATE_TABLE.update_item(
+            Key={'pk': get_playlist_entry_key(job_key, index)},
+            UpdateExpression="SET #status = :in_progress, lease_until = :lease_until ADD attempts :one",
+            ConditionExpression="#status = :dispatched OR (#status = :in_progress AND lease_until < :now)",
+            ExpressionAttributeNames={'#status': "status"},
+            ExpressionAttributeValues={':in_progress': "in_progress", ':dispatched': "dispatched", ':now': now,
+                                       ':lease_until': now + int(lease_seconds), ':one': 1},
+            ReturnValues="UPDATED_NEW")['Attributes']['attempts'])
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.info(f"Playlist entry {index} of {job_key} already processed or in progress, dropped")
+            return None
+        logger.error(f"Error claiming playlist entry {index} of {job_key}: {e}")
+        return 1  # Rather process twice than not at all
+
+
+def finish_playlist_entry(job_key, index, success):
+    """
+    Mark a playlist entry done or failed. Return False if it was already counted (a retry that finished
+    after its entry was given up on, or a duplicate invocation)
+    """
+    try:
+        STATE_TABLE.update_item(
+            Key={'pk': get_playlist_entry_key(job_key, index)},
+            UpdateExpression="SET #status = :status REMOVE lease_until",
+            ConditionExpression="#status IN (:dispatched, :in_progress)",
+            ExpressionAttributeNames={'#status': "status"},
+            ExpressionAttributeValues={':status': "done" if success else "failed", ':dispatched': "dispatched",
+                                       ':in_progress': "in_progress"})
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.info(f"Playlist entry {index} of {job_key} already counted")
+            return False
+        raise
+
+
+def get_stalled_playlist_entries(job):
+    """
+    Return the indexes of the pending entries of a playlist job that will never finish: their last attempt
+    is over, or their invocation is over and Lambda didn't retry it within PLAYLIST_ENTRY_RETRY_GRACE_SECONDS
+    (or never started it)
+    """
+    pending = sorted(int(index) for index in job.get('pending') or [])
+    if not pending:
+        return []
+    keys = [{'pk': get_playlist_entry_key(job['pk'], index)} for index in pending]
+    response = DYNAMODB.batch_get_item(RequestItems={STATE_TABLE.name: {'Keys': keys, 'ConsistentRead': True}})
+    now = int(time.time())
+    stalled = []
+    for entry in response['Responses'].get(STATE_TABLE.name, []):
+        if entry.get('status') not in ("dispatched", "in_progress") or 'lease_until' not in entry:
+            continue
+        lease_until = int(entry['lease_until'])
+        if (int(entry.get('attempts', 0)) >= PLAYLIST_ENTRY_MAX_ATTEMPTS and lease_until < now) \
+                or lease_until + PLAYLIST_ENTRY_RETRY_GRACE_SECONDS < now:
+            stalled.append(int(entry['pk'].rsplit('#', 1)[1]))
+    return stalled
+
+
+def playlist_entry_done(job_key, index, success):
+    """
+    Fan-in of a playlist job: count the finished entry once, along with the pending entries that stalled
+    (counted as failed), dispatch the next pending ones and, for the very last entry, send the summary
+    (and build the bundle)
+    """
+    finished = [(index, success)] if finish_playlist_entry(job_key, index, success) else []
+    job = STATE_TABLE.get_item(Key={'pk': job_key}, ConsistentRead=True).get('Item')
+    if job is None:
+        return  # Already summarized
+    for stalled_index in get_stalled_playlist_entries(job):
+        if stalled_index != index and finish_playlist_entry(job_key, stalled_index, False):
+            logger.warning(f"Playlist entry {stalled_index} of {job_key} stalled, counted as failed")
+            finished.append((stalled_index, False))
+    for finished_index, finished_success in finished:
+        count_playlist_entry(job_key, finished_index, finished_success)
+
+
+def count_playlist_entry(job_key, index, success):
+    counter = 'completed' if success else 'failed'
+    try:
+        job = STATE_TABLE.update_item(
+            Key={'pk': job_key},
+            UpdateExpression=f"ADD {counter} :one DELETE pending :index",
+            ConditionExpression="attribute_exists(pk)",
+            ExpressionAttributeValues={':one': 1, ':index': {int(index)}},
+            ReturnValues="ALL_NEW")['Attributes']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return  # Already summarized
+        raise
+    job['chat_id'] = int(job['chat_id'])  # DynamoDB numbers come back as Decimal
+
+    try:
+        dispatched = STATE_TABLE.update_item(
+            Key={'pk': job_key},
+            UpdateExpression="ADD dispatched :one",
+            ConditionExpression="dispatched < #total",
+            ExpressionAttributeNames={'#total': "total"},
+            ExpressionAttributeValues={':one': 1},
+            ReturnValues="UPDATED_NEW")['Attributes']['dispatched']
+        next_index = int(dispatched) - 1
+        STATE_TABLE.update_item(Key={'pk': job_key}, UpdateExpression="ADD pending :index",
+                                ExpressionAttributeValues={':index': {next_index}})
+        dispatch_playlist_entry(job, next_index)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise  # Otherwise every entry has already been dispatched
+
+    if int(job['completed']) + int(job['failed']) < int(job['total']):
+        return
+
+    chat_id = job['chat_id']
+    summary = f"✅ Playlist \"{job['title']}\" done: {int(job['completed'])}/{int(job['total'])} downloaded"
+    if int(job['failed']):
+        summary += f", {int(job['failed'])} failed"
+    send_message(chat_id, summary)
+
+    if job.get('bundle_prefix') and int(job['completed']):
+        bundle_playlist(job)
+    STATE_TABLE.delete_item(Key={'pk': job_key})
+
+
+def bundle_playlist(job):
+    """
+    Stream every file of the playlist folder into a single (stored) zip on S3, then send its link
+    """
+    s3 = get_aws_client('s3')
+    bundle_prefix = job['bundle_prefix']
+    file_name = f"{job['title'].replace('/', '_')}.zip"
+    s3_key = get_s3_key(job['chat_id'], file_name, job.get('first_name'), job.get('last_name'))
+
+    keys = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=S3_YT_VIDEOS_BUCKET_NAME, Prefix=bundle_prefix):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+
+    try:
+        with S3MultipartWriter(S3_YT_VIDEOS_BUCKET_NAME, s3_key, ContentType=MEDIA_CONTENT_TYPES[".zip"]) as writer:
+            with zipfile.ZipFile(writer, 'w', zipfile.ZIP_STORED) as zipf:
+                for key in keys:
+                    body = s3.get_object(Bucket=S3_YT_VIDEOS_BUCKET_NAME, Key=key)['Body']
+                    with zipf.open(key[len(bundle_prefix):], 'w', force_zip64=True) as entry:
+                        shutil.copyfileobj(body, entry, S3_MULTIPART_PART_SIZE)
+        add_to_s3_manifest(s3_key, writer.bytes_written)
+        send_download_link(job['chat_id'], s3_key, file_name, writer.bytes_written / (1024 * 1024), "playlist",
+                           note=" (as a zip file)")
+    except Exception as e:
+        logger.error(f"Error bundling playlist {bundle_prefix}: {e}", exc_info=True)
+        send_message(job['chat_id'], "Sorry, there was an error creating the playlist archive 🥲")
+    finally:
+        try:
+            delete_s3_keys(keys)
+        except ClientError as e:
+            logger.error(f"Error deleting the playlist folder {bundle_prefix}: {e}")
+
+
+def claim_update(update_id, lease_seconds=JOB_LOCK_TTL_SECONDS):
+    """
+    Record a Telegram update_id as in progress with a conditional write. Return False if it was already
+    processed or is being processed (Telegram redelivers updates when the webhook answers too slowly).
+    The claim of an invocation that died without releasing it (timeout) can be taken over after lease_seconds,
+    so that Lambda's retry of the invocation still processes the update
+    """
+    now = int(time.time())
+    try:
+        STATE_TABLE.put_item(
+            Item={'pk': f"update#{update_id}", 'status': "in_progress", 'lease_until': now + int(lease_seconds),
+                  'expires_at': now + UPDATE_DEDUP_TTL_SECONDS},
+            ConditionExpression="attribute_not_exists(pk) OR (#status = :in_progress AND lease_until < :now)",
+            ExpressionAttributeNames={'#status': "status"},
+            ExpressionAttributeValues={':in_progress': "in_progress", ':now': now})
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.info(f"Duplicate Telegram update {update_id} dropped")
+            return False
+        logger.error(f"Error recording Telegram update {update_id}: {e}")
+        return True  # Rather process twice than not at all
+
+
+def complete_update(update_id):
+    """
+    Mark a claimed update as done, its redeliveries are dropped until the claim expires
+    """
+    try:
+        STATE_TABLE.update_item(
+            Key={'pk': f"update#{update_id}"},
+            UpdateExpression="SET #status = :done REMOVE lease_until",
+            ExpressionAttributeNames={'#status': "status"},
+            ExpressionAttributeValues={':done': "done"})
+    except ClientError as e:
+        logger.error(f"Error completing Telegram update {update_id}: {e}")
+
+
+def release_update(update_id):
+    """
+    Drop the claim of an update whose processing failed, so that Lambda's retry can process it again
+    """
+    try:
+        STATE_TABLE.delete_item(Key={'pk': f"update#{update_id}"})
+    except ClientError as e:
+        logger.error(f"Error releasing Telegram update {update_id}: {e}")
+
+
+def acquire_job_lock(job_key, lease_seconds=JOB_LOCK_TTL_SECONDS):
+    """
+    Take the in-flight lock of a download job. Return False if an identical job is already running.
+    The lock expires after lease_seconds, the time left to the invocation, so that a lock left by a timed
+    out invocation doesn't block Lambda's retry of it
+    """
+    now = int(time.time())
+    try:
+        STATE_TABLE.put_item(
+            Item={'pk': job_key, 'expires_at': now + int(lease_seconds)},
+            ConditionExpression="attribute_not_exists(pk) OR expires_at < :now",
+            ExpressionAttributeValues={':now': now})
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.info(f"Job {job_key} already in flight, duplicate dropped")
+            return False
+        logger.error(f"Error acquiring job lock {job_key}: {e}")
+        return True
+
+
+def release_job_lock(job_key):
+    try:
+        STATE_TABLE.delete_item(Key={'pk': job_key})
+    except ClientError as e:
+        logger.error(f"Error releasing job lock {job_key}: {e}")
+
+
 def invoke_lambda_async(payload):
     """
-    Invoke the same Lambda function asynchronously to process the video download
+    Invoke the same Lambda function asynchronously to process an update or a playlist entry
     """
-    lambda_client = boto3.client('lambda')
+    lambda_client = get_aws_client('lambda')
     lambda_client.invoke(
         FunctionName=os.environ.get('AWS_LAMBDA_FUNCTION_NAME'),
         InvocationType='Event',  # Asynchronous invocation
@@ -430,34 +2782,68 @@ def invoke_lambda_async(payload):
     )
 
 
-def handle_history_command(chat_id):
+def handle_history_command(chat_id, message_text):
     """
-    Handle the /history command to retrieve and display the user's message history
+    Handle the /history command to display the user's latest messages, /history next continues
+    with older ones from the cursor saved by the previous page
     """
-    limit = 25
-    messages = get_message_history(chat_id, limit)
+    limit = HISTORY_PAGE_SIZE
+    cursor_key = {'pk': f"history_cursor#{chat_id}"}
+    cursor, offset = None, 0
+
+    if message_text.split()[1:2] == ["next"]:
+        saved = STATE_TABLE.get_item(Key=cursor_key).get('Item')
+        if not saved or int(saved['expires_at']) < time.time():
+            send_message(chat_id, "ℹ️ No more messages, send /history to start from the latest ones 📭")
+            return
+        cursor, offset = saved['cursor'], int(saved['offset'])
+
+    messages, next_cursor = get_message_history(chat_id, limit, cursor)
     if messages is None:
         send_message(chat_id, "Sorry, there was an error retrieving your message history 🥲")
     elif messages:
-        response = f"📜 Your recent messages (up to {limit}):\n\n"
-        for i, msg in enumerate(messages, 1):
+        lines = [f"📜 Your messages, most recent first ({offset + 1} to {offset + len(messages)}):\n\n"]
+        for i, msg in enumerate(messages, offset + 1):
             timestamp = datetime.fromisoformat(msg['timestamp']).strftime('%Y-%m-%d at %H:%M:%S')
-            text = msg['message']
-            response += f"{i} - {timestamp}: {text}\n\n"
-        send_message(chat_id, response)
+            lines.append(f"{i} - {timestamp}: {msg['message']}\n\n")
+        if next_cursor:
+            lines.append("Send /history next for older messages")
+        send_message(chat_id, "".join(lines))
     else:
         send_message(chat_id, "No message history found 📭")
 
+    if next_cursor:
+        STATE_TABLE.put_item(Item={
+            **cursor_key,
+            'cursor': next_cursor,
+            'offset': offset + len(messages),
+            'expires_at': int(time.time()) + HISTORY_CURSOR_TTL_SECONDS})
+    else:
+        STATE_TABLE.delete_item(Key=cursor_key)
+
 
-def handle_list_command(chat_id, first_name, last_name):
+def handle_list_command(chat_id, message_text, first_name, last_name):
     """
-    Handle the /list command to list all videos in the user's S3 folder
+    Handle the /list command to list the videos in the user's S3 folder.
+    Options: "size" sorts by size, "rebuild" resyncs the index with S3, a number selects the page
     """
-    videos = list_s3_videos(chat_id, first_name, last_name)
-    if videos:
-        message = "📋 Your available videos:\n\n"
-        for i, video in enumerate(videos, 1):
+    options = message_text.lower().split()[1:]
+    sort_by = "size" if "size" in options else "date"
+    page = next((int(option) for option in options if option.isdigit() and int(option) > 0), 1)
+
+    videos = list_s3_videos(chat_id, first_name, last_name, sort_by=sort_by, rebuild="rebuild" in options)
+    if videos is None:
+        send_message(chat_id, "Sorry, there was an error listing your videos 🥲")
+    elif videos:
+        pages = (len(videos) + LIST_PAGE_SIZE - 1) // LIST_PAGE_SIZE
+        page = min(page, pages)
+        start = (page - 1) * LIST_PAGE_SIZE
+        order = "largest" if sort_by == "size" else "newest"
+        message = f"📋 Your available videos ({order} first, page {page}/{pages}):\n\n"
+        for i, video in enumerate(videos[start:start + LIST_PAGE_SIZE], start + 1):
             message += f"{i} - {video}\n\n"
+        if page < pages:
+            message += f"Send /list {sort_by} {page + 1} for the next page"
         send_message(chat_id, message)
     else:
         send_message(chat_id, "No videos available, nothing, nada 🧹")
@@ -465,12 +2851,23 @@ def handle_list_command(chat_id, first_name, last_name):
 
 def handle_delete_command(chat_id, message_text, first_name, last_name):
     """
-    Handle the /delete command to delete a specific video from the user's S3 folder
+    Handle the /delete command to delete a specific video, or all videos matching a pattern,
+    from the user's S3 folder
     """
     parts = message_text.split(maxsplit=1)  # keep maxsplit=1 because filenames can have spaces
 
     if len(parts) > 1:
         file_name = parts[1].strip()
+        if any(char in file_name for char in "*?["):
+            deleted_count = delete_s3_files(chat_id, first_name, last_name, pattern=file_name)
+            if deleted_count > 0:
+                send_message(chat_id, f"""✅ Deleted {deleted_count} file(s) matching "{file_name}" 🫡""")
+            elif deleted_count == 0:
+                send_message(chat_id, f"""ℹ️ No files matching "{file_name}" 📭""")
+            else:
+                send_message(chat_id, "❌ Error deleting files, please try again 🥲")
+            return
+
         success = delete_s3_video(chat_id, file_name, first_name, last_name)
         if success:
             send_message(chat_id, f"""✅ Video "{file_name}" deleted, c'est ciao 🫡""")
@@ -480,17 +2877,26 @@ def handle_delete_command(chat_id, message_text, first_name, last_name):
         send_message(chat_id, "❌ Please specify the filename to delete, for example /delete filename.zip")
 
 
-def handle_empty_command(chat_id, first_name, last_name):
+def handle_empty_command(chat_id, message_text, first_name, last_name):
     """
-    Handle the /empty command to delete all zip files from the user's S3 folder
+    Handle the /empty command to delete all zip and media files from the user's S3 folder,
+    "/empty older-than 7d" (or 12h) only deletes the older ones
     """
-    deleted_count = delete_all_s3_zips(chat_id, first_name, last_name)
+    older_than_seconds = None
+    if len(message_text.split()) > 1:
+        match = re.fullmatch(r"/empty\s+older-than\s+(\d+)([dh])", message_text.strip().lower())
+        if not match:
+            send_message(chat_id, "❌ Usage: /empty or /empty older-than 7d (or 12h)")
+            return
+        older_than_seconds = int(match.group(1)) * (86400 if match.group(2) == "d" else 3600)
+
+    deleted_count = delete_s3_files(chat_id, first_name, last_name, older_than_seconds=older_than_seconds)
     if deleted_count > 0:
-        send_message(chat_id, f"""✅ Deleted {deleted_count} zip file(s), all clean now 🧹""")
+        send_message(chat_id, f"""✅ Deleted {deleted_count} file(s), all clean now 🧹""")
     elif deleted_count == 0:
-        send_message(chat_id, "ℹ️ No zip files found to delete 📭")
+        send_message(chat_id, "ℹ️ No files found to delete 📭")
     else:
-        send_message(chat_id, "❌ Error deleting zip files, please try again 🥲")
+        send_message(chat_id, "❌ Error deleting files, please try again 🥲")
 
 
 def handle_info_command(chat_id):
@@ -498,19 +2904,24 @@ def handle_info_command(chat_id):
     Handle the /info command to display system information including yt-dlp version
     """
     try:
-        command = [YT_DLP_PATH, "--version"]
-        process = subprocess.run(command, capture_output=True, text=True)
-
-        if process.returncode == 0:
-            version = process.stdout.strip()
+        version = get_ytdlp_version()
+
+        if version:
+            stats = STATE_TABLE.get_item(Key={'pk': "cache#stats"}).get('Item', {})
+            hits, misses = int(stats.get('hits', 0)), int(stats.get('misses', 0))
+            hit_ratio = hits / (hits + misses) * 100 if hits + misses else 0
+            stats = STATE_TABLE.get_item(Key={'pk': "yt_dlp_cache#stats"}).get('Item', {})
+            ytdlp_hits, ytdlp_misses = int(stats.get('hits', 0)), int(stats.get('misses', 0))
+            ytdlp_hit_ratio = ytdlp_hits / (ytdlp_hits + ytdlp_misses) * 100 if ytdlp_hits + ytdlp_misses else 0
             message = f"""ℹ️ System Information
 
 📦 yt-dlp version: {version}
+🗄️ Download cache: {hits} hits, {misses} misses ({hit_ratio:.0f}% hit ratio)
+🧩 yt-dlp cache: {ytdlp_hits} hits, {ytdlp_misses} misses ({ytdlp_hit_ratio:.0f}% hit ratio)
 
 This bot uses yt-dlp to download videos from YouTube and other platforms."""
             send_message(chat_id, message)
         else:
-            logger.error(f"yt-dlp version check failed: {process.stderr}")
             send_message(chat_id, "❌ Unable to retrieve system information 🥲")
     except Exception as e:
         logger.error(f"Error in handle_info_command: {e}")
@@ -539,16 +2950,17 @@ def handle_test_command(chat_id):
         shutil.rmtree(temp_dir, ignore_errors=True)
 
 
-def handle_video_download(chat_id, message_text, first_name, last_name):
+def handle_video_download(chat_id, message_text, first_name, last_name, lease_seconds=JOB_LOCK_TTL_SECONDS):
     """
     Handle the video download request
     """
     parts = message_text.strip().split()
-    if len(parts) != 2:
+    if len(parts) not in (2, 3):
         send_message(chat_id, HELP_MESSAGE)
         return {'statusCode': 200, 'body': json.dumps('Invalid input')}
 
     url, resolution = parts[0], parts[1].lower()
+    option = parts[2].lower() if len(parts) == 3 else None
     print(f"*** URL : {url}")
     print(f"*** resolution : {resolution}")
 
@@ -557,106 +2969,265 @@ def handle_video_download(chat_id, message_text, first_name, last_name):
         send_message(chat_id, "Don't even think about it 🤨")
         return {'statusCode': 200, 'body': json.dumps('Invalid URL')}
 
-    # Check for playlist URL
+    # Check for playlist URL (a video in a playlist is downloaded alone)
+    is_playlist = False
     if "list" in url:
         if "watch" in url:
             url = url.split("&list")[0]
         else:
-            send_message(chat_id, "Playlist download is not supported ❌")
-            return {'statusCode': 200, 'body': json.dumps('Invalid URL')}
+            is_playlist = True
 
     # Check for valid resolution
-    if resolution not in FORMATS.keys():
+    if resolution not in FORMATS.keys() and resolution != FIT_RESOLUTION:
         send_message(chat_id, HELP_MESSAGE)
         return {'statusCode': 200, 'body': json.dumps('Invalid resolution')}
 
-    # Invoke the same Lambda function asynchronously to process the video
-    payload = {
-        'type': 'process_video',
-        'chat_id': chat_id,
-        'first_name': first_name,
-        'last_name': last_name,
-        'url': url,
-        'resolution': resolution}
-    invoke_lambda_async(payload)
+    # Check for valid option: "zip" for a playlist, a time range for a video
+    section = None
+    if option is not None and not (is_playlist and option == "zip"):
+        section = parse_clip_section(option)
+        if section is None:
+            send_message(chat_id, HELP_MESSAGE)
+            return {'statusCode': 200, 'body': json.dumps('Invalid option')}
+        if is_playlist:
+            send_message(chat_id, "Clips can only be taken from a single video, not from a playlist 🤔")
+            return {'statusCode': 200, 'body': json.dumps('Invalid option')}
+
+    # Expand the playlist and fan its entries out to other invocations
+    if is_playlist:
+        process_playlist_download(chat_id, url, resolution, option == "zip", first_name, last_name)
+        return {'statusCode': 200, 'body': json.dumps('Playlist processing started')}
+
+    # Drop the request if the same video is already being downloaded for this chat
+    job_lock = f"job#{chat_id}#{get_video_id(url) or url}#{resolution}"
+    if section:
+        job_lock += f"#{format_clip_section(section)}"
+    if not acquire_job_lock(job_lock, lease_seconds):
+        send_message(chat_id, "⏳ This video is already being downloaded, please wait...")
+        return {'statusCode': 200, 'body': json.dumps('Duplicate job')}
+
+    try:
+        process_video_download(chat_id, url, resolution, first_name, last_name, section=section)
+    finally:
+        release_job_lock(job_lock)
+
+    return {'statusCode': 200, 'body': json.dumps('Video processing completed')}
+
+
+def parse_update(body):
+    """
+    Extract chat_id, message text, first_name and last_name of a Telegram update, None if it has no text message
+    """
+    for message_key in ('message', 'edited_message'):
+        try:
+            message = body[message_key]
+            chat = message['chat']
+            return chat['id'], message['text'].strip(), chat.get('first_name'), chat.get('last_name')
+        except (KeyError, TypeError, AttributeError):
+            continue
+    return None
+
+
+def get_command_name(message_text):
+    """
+    Return the command of a message for the metric dimensions, "other" for unknown commands
+    (every distinct dimension value is a billed custom metric)
+    """
+    if message_text.startswith('/'):
+        command = message_text.split()[0].split('@')[0]
+        return command if command in METRIC_COMMANDS else "other"
+    return "download"
+
+
+def record_latency(metric_name, command, seconds):
+    """
+    Emit a latency sample as an EMF metric by command, with the p50/p99 of the recent samples of
+    this container as properties that CloudWatch Logs Insights can query
+    """
+    milliseconds = seconds * 1000
+    samples = LATENCY_SAMPLES.setdefault((metric_name, command), deque(maxlen=LATENCY_SAMPLES_SIZE))
+    samples.append(milliseconds)
+    ordered = sorted(samples)
+    emit_metrics({metric_name: (round(milliseconds, 1), "Milliseconds")}, {"Command": command}, properties={
+        "p50": round(ordered[len(ordered) // 2], 1),
+        "p99": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 1),
+        "samples": len(ordered)})
+
+
+def get_lease_seconds(context=None):
+    """
+    Return how long the claims of this invocation last: the time left to it, JOB_LOCK_TTL_SECONDS outside Lambda
+    """
+    return context.get_remaining_time_in_millis() / 1000 if context else JOB_LOCK_TTL_SECONDS
+
+
+def process_update(body, context=None):
+    """
+    Process a Telegram update in the worker invocation, at most once: the update is claimed while
+    it runs, marked done when it succeeds and released when it fails, for Lambda's retry
+    """
+    update_id = body.get('update_id')
+    # A timed out invocation can't release its claim nor its job lock, their lease ends with the invocation
+    lease_seconds = get_lease_seconds(context)
+
+    # Telegram (and the async invocation) may deliver an update twice, process each update only once
+    if update_id is not None and not claim_update(update_id, lease_seconds):
+        return {'statusCode': 200, 'body': json.dumps('Duplicate update')}
+
+    try:
+        response = run_update(body, lease_seconds)
+    except Exception:
+        if update_id is not None:
+            release_update(update_id)
+        raise
+    if update_id is not None:
+        complete_update(update_id)
+    return response
+
+
+def run_update(body, lease_seconds=JOB_LOCK_TTL_SECONDS):
+    """
+    Save the message of a Telegram update and run the command or download.
+    lease_seconds bounds the download's job lock, like the claim of the update
+    """
+    start = time.time()
+
+    parsed = parse_update(body)
+    if parsed is None:
+        return {'statusCode': 200, 'body': json.dumps('Invalid message format')}
+    chat_id, message_text, first_name, last_name = parsed
+    logger.info(f"Message Text: {message_text}")
+
+    # Save the message to DynamoDB before processing: a download runs for minutes and may time out,
+    # so the buffer is written now rather than at the end of the invocation
+    save_message_to_dynamodb(chat_id, message_text, first_name, last_name)
+    flush_message_history()
 
-    return {'statusCode': 200, 'body': json.dumps('Video processing started')}
+    try:
+        # Command: /history - Show message history
+        if message_text.startswith('/history'):
+            handle_history_command(chat_id, message_text)
+            return {'statusCode': 200, 'body': json.dumps('History command processed')}
+
+        # Command: /list - List all videos in S3 bucket for this user
+        elif message_text.startswith('/list'):
+            handle_list_command(chat_id, message_text, first_name, last_name)
+            return {'statusCode': 200, 'body': json.dumps('List command processed')}
+
+        # Command: /delete filename.zip - Delete a specific video
+        elif message_text.startswith('/delete'):
+            handle_delete_command(chat_id, message_text, first_name, last_name)
+            return {'statusCode': 200, 'body': json.dumps('Delete command processed')}
+
+        # Command: /empty - Delete all zip and media files
+        elif message_text.startswith('/empty'):
+            handle_empty_command(chat_id, message_text, first_name, last_name)
+            return {'statusCode': 200, 'body': json.dumps('Empty command processed')}
+
+        # Command: /info - Display system information
+        elif message_text.startswith('/info'):
+            handle_info_command(chat_id)
+            return {'statusCode': 200, 'body': json.dumps('Info command processed')}
+
+        # Command: /test - Test the download pipeline
+        elif message_text.startswith('/test'):
+            handle_test_command(chat_id)
+            return {'statusCode': 200, 'body': json.dumps('Test command processed')}
+
+        # Command: /help or /start - Show available commands
+        elif message_text.startswith('/help') or message_text.startswith('/start'):
+            send_message(chat_id, HELP_MESSAGE)
+            return {'statusCode': 200, 'body': json.dumps('Help command processed')}
+
+        # Standard video download command
+        else:
+            response = handle_video_download(chat_id, message_text, first_name, last_name, lease_seconds)
+            return response
+    finally:
+        record_latency("UpdateProcessingLatency", get_command_name(message_text), time.time() - start)
 
 
 def lambda_handler(event, context):
-    print(f"*** Bot Token : {get_secret_bot_token()}")
+    try:
+        return handle_event(event, context)
+    finally:
+        flush_message_history()
+        persist_yt_dlp_cache()
+
+
+def handle_event(event, context=None):
+    print(f"*** Bot token cache : {BOT_TOKEN_CACHE['hits']} hits, {BOT_TOKEN_CACHE['misses']} misses")
+    print(f"*** boto3 clients : {AWS_CLIENTS_STATS['created']} created, {AWS_CLIENTS_STATS['reused']} reused")
     print(f"*** Event : {event}")
 
-    # Check if this is an async video processing invocation
+    # Check if this is an async update processing invocation
+    if event.get('type') == 'process_update':
+        return process_update(event.get('update', {}), context)
+
+    # Check if this is an async playlist entry invocation
     if event.get('type') == 'process_video':
         chat_id = event.get('chat_id')
         first_name = event.get('first_name')
         last_name = event.get('last_name')
         url = event.get('url')
         resolution = event.get('resolution')
-        process_video_download(chat_id, url, resolution, first_name, last_name)
-        return {'statusCode': 200, 'body': json.dumps('Video processing completed')}
-
-    # Regular webhook handling
-    body = json.loads(event.get('body', '{}'))
-    print(f"*** Body : {body}")
-    try:
-        chat_id = body['message']['chat']['id']
-        message_text = body['message']['text']
-        first_name = body['message']['chat'].get('first_name')
-        last_name = body['message']['chat'].get('last_name')
-    except KeyError:
+        playlist_job = event.get('playlist_job')
+        entry_index = event.get('entry_index')
+        deadline_timer = None
+        if playlist_job:
+            # Lambda retries an entry invocation that timed out, each entry is counted once
+            lease_seconds = get_lease_seconds(context)
+            attempt = claim_playlist_entry(playlist_job, entry_index, lease_seconds)
+            if attempt is None:
+                return {'statusCode': 200, 'body': json.dumps('Duplicate playlist entry')}
+            if attempt >= PLAYLIST_ENTRY_MAX_ATTEMPTS and context:
+                # No retry will follow a timeout of the last attempt: count the entry as failed just before it,
+                # in an invocation of its own, so that the job still ends
+                deadline_timer = threading.Timer(
+                    max(lease_seconds - PLAYLIST_ENTRY_DEADLINE_MARGIN_SECONDS, 0), invoke_lambda_async,
+                    args=[{'type': 'playlist_entry_done', 'playlist_job': playlist_job, 'entry_index': entry_index,
+                           'success': False}])
+                deadline_timer.daemon = True
+                deadline_timer.start()
         try:
-            chat_id = body['edited_message']['chat']['id']
-            message_text = body['edited_message']['text']
-            first_name = body['edited_message']['chat'].get('first_name')
-            last_name = body['edited_message']['chat'].get('last_name')
-        except KeyError:
-            return {'statusCode': 200, 'body': json.dumps('Invalid message format')}
-
-    # Strip message_text
-    message_text = message_text.strip()
-    logger.info(f"Message Text: {message_text}")
+            success = process_video_download(chat_id, url, resolution, first_name, last_name,
+                                             quiet=playlist_job is not None, bundle_prefix=event.get('bundle_prefix'))
+        except Exception as e:
+            if not playlist_job:
+                raise
+            # The entry must still be counted, or the next ones are never dispatched and no summary is sent
+            # (and a raised error would make Lambda retry the whole entry)
+            logger.error(f"Error processing playlist entry {url}: {e}", exc_info=True)
+            success = False
+        finally:
+            if deadline_timer:
+                deadline_timer.cancel()
+        if playlist_job:
+            playlist_entry_done(playlist_job, entry_index, success)
+        return {'statusCode': 200, 'body': json.dumps('Video processing completed')}
 
-    # Save the message to DynamoDB before processing
-    save_message_to_dynamodb(chat_id, message_text, first_name, last_name)
+    # Check if this is the fan-in of a playlist entry given up on (see above)
+    if event.get('type') == 'playlist_entry_done':
+        playlist_entry_done(event['playlist_job'], event['entry_index'], event.get('success', False))
+        return {'statusCode': 200, 'body': json.dumps('Playlist entry counted')}
 
-    # Command: /history - Show message history
-    if message_text.startswith('/history'):
-        handle_history_command(chat_id)
-        return {'statusCode': 200, 'body': json.dumps('History command processed')}
-
-    # Command: /list - List all videos in S3 bucket for this user
-    elif message_text.startswith('/list'):
-        handle_list_command(chat_id, first_name, last_name)
-        return {'statusCode': 200, 'body': json.dumps('List command processed')}
-
-    # Command: /delete filename.zip - Delete a specific video
-    elif message_text.startswith('/delete'):
-        handle_delete_command(chat_id, message_text, first_name, last_name)
-        return {'statusCode': 200, 'body': json.dumps('Delete command processed')}
-
-    # Command: /empty - Delete all zip files
-    elif message_text.startswith('/empty'):
-        handle_empty_command(chat_id, first_name, last_name)
-        return {'statusCode': 200, 'body': json.dumps('Empty command processed')}
-
-    # Command: /info - Display system information
-    elif message_text.startswith('/info'):
-        handle_info_command(chat_id)
-        return {'statusCode': 200, 'body': json.dumps('Info command processed')}
-
-    # Command: /test - Test the download pipeline
-    elif message_text.startswith('/test'):
-        handle_test_command(chat_id)
-        return {'statusCode': 200, 'body': json.dumps('Test command processed')}
-
-    # Command: /help or /start - Show available commands
-    elif message_text.startswith('/help') or message_text.startswith('/start'):
-        send_message(chat_id, HELP_MESSAGE)
-        return {'statusCode': 200, 'body': json.dumps('Help command processed')}
+    # Regular webhook handling: acknowledge right away, the update is processed by an async invocation
+    start = time.time()
+    metrics = JobMetrics("webhook", Command="invalid")
+    parse_start = time.time()
+    body = json.loads(event.get('body') or '{}')
+    print(f"*** Body : {body}")
 
-    # Standard video download command
-    else:
-        response = handle_video_download(chat_id, message_text, first_name, last_name)
-        return response
+    parsed = parse_update(body)
+    metrics.add_stage("parse", time.time() - parse_start, len(event.get('body') or ''))
+    if parsed is None:
+        metrics.emit()
+        return {'statusCode': 200, 'body': json.dumps('Invalid message format')}
+    metrics.dimensions["Command"] = get_command_name(parsed[1])
+
+    dispatch_start = time.time()
+    invoke_lambda_async({'type': 'process_update', 'update': body})
+    metrics.add_stage("dispatch", time.time() - dispatch_start)
+    record_latency("WebhookAckLatency", metrics.dimensions["Command"], time.time() - start)
+    metrics.emit()
+    return {'statusCode': 200, 'body': json.dumps('Update dispatched')}